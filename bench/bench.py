@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+# murmur - loopback benchmark of the control -> node pipeline
+# 10/18/26
+
+'''
+starts node receive servers on loopback addresses 127.0.0.2, 127.0.0.3, ...
+with one of the recording relay backends standing in for GPIO, and drives them
+through the real Sender, and the real Timer running a time-compressed Anchorage
+sequence. nothing else needs to be running, e.g.:
+
+    python3 bench/bench.py --nodes 4 --speed 100 --output bench_output.txt
+
+there are two phases:
+    throughput  sends 'commands' single step batches (low and top toggles, so the
+                mid valve interlock never holds them up) as fast as send_many()
+                takes them, and reports commands/sec and ack latency.
+    schedule    runs 'sequence' through Timer.run() at 'speed' times real time and
+                compares when every relay actually changed against the compiled
+                timeline. lateness is actual minus ideal time for every change,
+                skew is the difference in lateness between consecutive steps on
+                different arms, i.e. how far the gaps between arms drift.
+
+the 'latency' backend adds simulated GPIO and relay switching times on top, see
+nodes/backends.py. all times are reported in milliseconds. --output writes the
+results as json so runs can be compared with each other.
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import statistics
+import threading
+from datetime import datetime
+
+benchpath = os.path.dirname(os.path.realpath(__file__))
+rootpath = os.path.dirname(benchpath)
+sys.path[:0] = [os.path.join(rootpath, 'nodes'), os.path.join(rootpath, 'control'), rootpath]
+
+from backends import recorder
+from node import Node
+from receive import Receive
+from send import BatchMessage, Sender
+from timer import Anchorage, Timer
+from topology import load_topology
+
+
+topology = load_topology()
+
+
+class Compressed(object):
+    '''
+    a timer class such as Anchorage with every pause divided by speed, and every
+    action's order limited to the arms we have nodes for. the mid valve gaps are
+    left alone, since the nodes enforce them in real time anyway.
+    '''
+
+    def __init__(self, timer, speed, arms):
+        self.sequences = timer.sequences
+        self.actions = {
+            name: dict(action, order=[arm for arm in action['order'] if arm in arms])
+            for name, action in timer.actions.items()
+        }
+        self.pauses = {
+            name: {kind: pause / speed for kind, pause in pauses.items()}
+            for name, pauses in timer.pauses.items()
+        }
+
+
+def percentile(values, p):
+    '''nearest rank percentile of an already sorted list'''
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def summarize(seconds):
+    '''summary of a list of durations in seconds, in milliseconds'''
+    if not seconds:
+        return {'n': 0}
+
+    values = sorted(s * 1000 for s in seconds)
+
+    return {
+        'n': len(values),
+        'mean': statistics.mean(values),
+        'stdev': statistics.pstdev(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': values[-1]
+    }
+
+
+def start_nodes(host_arm_map, port, backend):
+    '''start a node and its receive server for every host, returns {host.local: (address, node)}'''
+    nodes = {}
+
+    for i, host in enumerate(host_arm_map):
+        address = '127.0.0.{}'.format(i + 2)
+        node = Node(host, backend=backend)
+        receive = Receive(node, hostport=(address, port))
+        threading.Thread(target=receive.server.serve_forever, name=host, daemon=True).start()
+        nodes[topology.address(host)] = (address, node)
+
+    return nodes
+
+
+def get_latencies(results):
+    return [latency for result in results.values() for latency in result.latencies]
+
+
+def check_errors(results):
+    for host, result in results.items():
+        if result.error:
+            raise result.error
+
+
+def bench_throughput(sender, host_arm_map, count):
+    arms = [(host, arm) for host, arms in host_arm_map.items() for arm in arms]
+    commands = []
+
+    for i in range(count):
+        host, arm = arms[i % len(arms)]
+        actuator = 'low' if (i // len(arms)) % 2 == 0 else 'top'
+        commands.append((topology.address(host), BatchMessage([(arm, actuator, (i // (2 * len(arms))) % 2 == 0, 0)])))
+
+    # one round first, so connecting and negotiating isn't part of the numbers
+    check_errors(sender.send_many(commands[:len(arms)]))
+
+    started = time.perf_counter()
+    results = sender.send_many(commands)
+    elapsed = time.perf_counter() - started
+    check_errors(results)
+
+    return {
+        'commands': count,
+        'seconds': elapsed,
+        'commands_per_second': count / elapsed,
+        'ack_latency': summarize(get_latencies(results))
+    }
+
+
+def get_relays(nodes):
+    '''map every relay to its (arm, actuator)'''
+    relays = {}
+
+    for _, node in nodes.values():
+        for arm_name, arm in node.arms.items():
+            for actuator, r in arm.actuators.items():
+                relays[r] = (arm_name, actuator)
+
+    return relays
+
+
+def get_lateness(timeline, nodes, changes, start, states):
+    '''
+    pair every record in the timeline with the relay change it caused, in order
+    per relay. the nodes only write relays that actually change, so records that
+    set a relay to the state it's already in (starting from states, a dict of
+    (arm, actuator) -> state) aren't expected to show up. returns a list of
+    (record, lateness in seconds), plus the number of records that never showed
+    up on a relay.
+    '''
+    relays = get_relays(nodes)
+
+    actual = {}
+
+    for t, r, _ in changes:
+        actual.setdefault(relays[r], []).append(t)
+
+    expected = {}
+    states = dict(states)
+
+    for i in sorted(range(len(timeline.offsets)), key=lambda i: (timeline.offsets[i], i)):
+        arm = timeline.arm_names[timeline.arms[i]]
+        actuator = timeline.actuator_names[timeline.actuators[i]]
+        node = nodes[timeline.host_names[timeline.hosts[i]]][1]
+        key = node._intercept_d_low(arm, actuator)
+
+        if states.get(key) != bool(timeline.activate[i]):
+            states[key] = bool(timeline.activate[i])
+            expected.setdefault(key, []).append(i)
+
+    lateness = []
+    missing = 0
+
+    for key, records in expected.items():
+        times = actual.get(key, [])
+        missing += max(0, len(records) - len(times))
+
+        for record, t in zip(records, times):
+            lateness.append((record, t - (start + timeline.offsets[record])))
+
+    return sorted(lateness), missing
+
+
+def get_skew(timeline, lateness):
+    '''difference in lateness between each step and the step before it on another arm'''
+    by_record = dict(lateness)
+    steps = []
+
+    for step, first in enumerate(timeline.step_starts):
+        if first in by_record:
+            steps.append((timeline.step_offsets[step], timeline.arms[first], by_record[first]))
+
+    steps.sort()
+    skew = []
+
+    for (_, arm, late), (_, previous_arm, previous_late) in zip(steps[1:], steps):
+        if arm != previous_arm:
+            skew.append(abs(late - previous_late))
+
+    return skew
+
+
+def bench_schedule(sender, timer, nodes, sequence, lead):
+    timeline = timer.timelines[sequence]
+    start = datetime.fromtimestamp(time.time() + lead)
+    latencies = []
+    sent = 0
+
+    # the recorder timestamps changes with time.monotonic(), so convert the start
+    monotonic_start = time.monotonic() + start.timestamp() - time.time()
+    states = {key: r.state for r, key in get_relays(nodes).items()}
+    recorder.clear()
+
+    for event in timer.run(sequence, start=start):
+        if event:
+            results = sender.send_many(event)
+            check_errors(results)
+            latencies.extend(get_latencies(results))
+            sent += len(event)
+
+    lateness, missing = get_lateness(timeline, nodes, recorder.snapshot(), monotonic_start, states)
+
+    return {
+        'sequence': sequence,
+        'steps': len(timeline),
+        'commands': sent,
+        'seconds': timeline.duration,
+        'missing_changes': missing,
+        'ack_latency': summarize(latencies),
+        'lateness': summarize([late for _, late in lateness]),
+        'skew': summarize(get_skew(timeline, lateness))
+    }
+
+
+def format_summary(name, summary):
+    if not summary['n']:
+        return '  {:<12} no samples'.format(name)
+
+    return '  {:<12} n={n:<6} mean={mean:8.3f}  p50={p50:8.3f}  p90={p90:8.3f}  p99={p99:8.3f}  max={max:8.3f}  stdev={stdev:7.3f}'.format(name, **summary)
+
+
+def report(results):
+    throughput = results['throughput']
+    schedule = results['schedule']
+    lines = [
+        'murmur loopback benchmark: {nodes} nodes, {arms} arms, {backend} relays, speed x{speed}'.format(**results['params']),
+        'throughput: {commands} commands in {seconds:.3f}s, {commands_per_second:.0f} commands/sec'.format(**throughput),
+        format_summary('ack latency', throughput['ack_latency']),
+        "schedule: '{sequence}', {steps} steps, {commands} commands over {seconds:.3f}s, {missing_changes} changes missing".format(**schedule),
+        format_summary('ack latency', schedule['ack_latency']),
+        format_summary('lateness', schedule['lateness']),
+        format_summary('skew', schedule['skew'])
+    ]
+
+    return '\n'.join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='murmur loopback benchmark')
+    parser.add_argument('--nodes', type=int, default=4, choices=range(1, len(topology.hosts) + 1), help='number of nodes to simulate')
+    parser.add_argument('--backend', default='recorder', choices=['recorder', 'latency'], help='relay backend for the simulated nodes')
+    parser.add_argument('--port', type=int, default=9999, help='port for the simulated nodes, on 127.0.0.2 and up')
+    parser.add_argument('--speed', type=float, default=100.0, help='how many times faster than real time to run the sequence')
+    parser.add_argument('--sequence', default='main_loop', help='Anchorage sequence to run')
+    parser.add_argument('--commands', type=int, default=2000, help='number of commands to send in the throughput phase')
+    parser.add_argument('--lead', type=float, default=0.5, help='seconds between compiling the schedule and the start of the sequence')
+    parser.add_argument('--json', dest='binary', action='store_false', help='send json instead of binary frames')
+    parser.add_argument('--output', help='also write the results to this file as json')
+    parser.add_argument('--log-level', default='WARNING', help='level for the pipeline loggers')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    host_arm_map = dict(list(topology.host_arm_map.items())[:args.nodes])
+    arms = [arm for host in host_arm_map for arm in host_arm_map[host]]
+    nodes = start_nodes(host_arm_map, args.port, args.backend)
+
+    sender = Sender('bench', binary=args.binary, addresses={host: address for host, (address, _) in nodes.items()})
+    sender.port = args.port
+    timer = Timer(timer=Compressed(Anchorage, args.speed, arms), host_arm_map=host_arm_map, interrupt=threading.Event())
+
+    results = {
+        'params': {
+            'nodes': args.nodes,
+            'arms': len(arms),
+            'speed': args.speed,
+            'backend': args.backend,
+            'binary': args.binary,
+            'python': platform.python_version(),
+            'date': datetime.now().isoformat(timespec='seconds')
+        },
+        'throughput': bench_throughput(sender, host_arm_map, args.commands),
+        'schedule': bench_schedule(sender, timer, nodes, args.sequence, args.lead)
+    }
+    sender.close()
+
+    print(report(results))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=4)
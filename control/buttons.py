@@ -13,10 +13,17 @@ from kivy.uix.togglebutton import ToggleButton
 from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.boxlayout import BoxLayout
 from kivy.graphics import Color, Rectangle
+import os
+import sys
 import subprocess
 from functools import partial, wraps
 from collections import namedtuple
 
+# for topology.py, at the top of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from topology import load_topology
+
 
 # NOTE: this decorator is not currently working, just here for reference
 def log_press(func):
@@ -33,7 +40,7 @@ class ButtonsLayout(FloatLayout):
 
     state_file = '/home/pi/gitbucket/murmur/control/state.txt'
     Buttons = namedtuple('Buttons', ['start', 'pause', 'shutdown', 'exit'])
-    hosts = ['pi@murmur01.local', 'pi@murmur02.local', 'pi@murmur03.local', 'pi@murmur04.local']
+    hosts = ['pi@{}'.format(load_topology().address(host)) for host in load_topology().hosts]
 
     def __init__(self, **kwargs):
         super(ButtonsLayout, self).__init__(**kwargs)
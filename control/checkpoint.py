@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+# murmur - checkpoint where a sequence is so control can pick up after a restart
+# 10/18/26
+
+import os
+import json
+import time
+import logging
+import threading
+
+
+class Checkpoint(object):
+    '''
+    a small json file with where the running sequence is: the sequence list and
+    sequence, the index, action and arm of the last step that was sent, its offset
+    into the sequence, when it was sent, and the shadow's actuator states.
+
+    save() is called on every step boundary and only swaps the latest checkpoint
+    in memory, a background thread writes it out. the file is written to a
+    temporary file, synced and renamed over the old one, so a crash or power cut
+    leaves either the previous checkpoint or the new one, never half of one.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = self._initialize_logger()
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()  # held while the file is written or removed
+        self.pending = None
+        self.dirty = threading.Event()
+        self.thread = None
+
+    def _initialize_logger(self):
+        logger = logging.getLogger('checkpoint')
+        logger.info('checkpoint logger instantiated')
+
+        return logger
+
+    def _write(self, state):
+        temp = '{}.tmp'.format(self.path)
+
+        with open(temp, 'w') as checkpoint:
+            checkpoint.write(json.dumps(state, separators=(',', ':')))
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+
+        os.replace(temp, self.path)
+
+    def _write_checkpoints(self):
+        while True:
+            self.dirty.wait()
+            self.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._write_checkpoints, name='checkpoint', daemon=True)
+        self.thread.start()
+
+    def save(self, sequence_list, timeline, step, states):
+        '''
+        checkpoint step of timeline as the last one sent while running sequence_list.
+        states is Shadow.dump(). without start() the checkpoint is written right away.
+        '''
+        action, arm = timeline.locate(step)
+        state = {
+            'sequence_list': sequence_list,
+            'sequence': timeline.sequence,
+            'step': step,
+            'action': action,
+            'arm': arm,
+            'offset': timeline.step_offsets[step],
+            'time': time.time(),
+            'states': states
+        }
+
+        with self.lock:
+            self.pending = state
+            self.dirty.set()
+
+        if self.thread is None:
+            self.flush()
+
+    def flush(self):
+        '''write the latest checkpoint out now, if it hasn't been already'''
+        with self.writing:
+            with self.lock:
+                state, self.pending = self.pending, None
+                self.dirty.clear()
+
+            if state is None:
+                return
+
+            try:
+                self._write(state)
+            except OSError as e:
+                self.logger.error('unable to write checkpoint {}: {}'.format(self.path, e))
+
+    def clear(self):
+        '''remove the checkpoint once there's nothing left to resume'''
+        with self.writing:
+            with self.lock:
+                self.pending = None
+                self.dirty.clear()
+
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def load(self):
+        '''return the last checkpoint as a dict, or None if there isn't a usable one'''
+        try:
+            with open(self.path, 'r') as checkpoint:
+                state = json.load(checkpoint)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.logger.error('unable to read checkpoint {}: {}'.format(self.path, e))
+            return None
+
+        self.logger.info("loaded checkpoint: step {step} of '{sequence}' (action {action}, arm {arm}) at {offset:.1f} seconds, {age:.1f} seconds ago".format(age=time.time() - state['time'], **state))
+
+        return state
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+# murmur - estimate the clock offset between control and each node
+# 10/18/26
+
+import time
+import logging
+import threading
+from collections import deque
+from send import SyncMessage
+
+
+class ClockEstimate(object):
+    '''
+    running estimate of one node's clock relative to ours, built NTP style from
+    sync exchanges. for an exchange where we send at t0, the node receives at t1
+    and replies at t2, and we receive the reply at t3 (t0 and t3 on our clock,
+    t1 and t2 on the node's):
+
+        rtt    = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+
+    so that node time = our time + offset. exchanges that were delayed on the
+    network have a large rtt and an unreliable offset, so each sync round does a
+    few exchanges and only the one with the smallest rtt is kept. the last
+    'window' kept samples are used to fit drift, the slope of the offset over
+    time in seconds per second, by least squares.
+    '''
+
+    def __init__(self, window=8):
+        self.pending = []  # (t, offset, rtt) samples from the current round
+        self.samples = deque(maxlen=window)  # best sample of each round, t on our clock
+        self.offset = 0.0
+        self.drift = 0.0
+        self.rtt = None
+        self.reference = time.time()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _fit_drift(self):
+        if len(self.samples) < 2:
+            return 0.0
+
+        mean_t = sum(t for t, _, _ in self.samples) / len(self.samples)
+        mean_offset = sum(offset for _, offset, _ in self.samples) / len(self.samples)
+        variance = sum((t - mean_t) ** 2 for t, _, _ in self.samples)
+
+        if not variance:
+            return 0.0
+
+        return sum((t - mean_t) * (offset - mean_offset) for t, offset, _ in self.samples) / variance
+
+    def add(self, t0, t1, t2, t3):
+        '''add one exchange to the current round, returns its (offset, rtt)'''
+        rtt = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        self.pending.append(((t0 + t3) / 2, offset, rtt))
+
+        return offset, rtt
+
+    def commit(self):
+        '''finish a round by keeping its lowest rtt sample and refitting drift'''
+        if not self.pending:
+            return
+
+        self.samples.append(min(self.pending, key=lambda sample: sample[2]))
+        self.pending = []
+        self.reference, self.offset, self.rtt = self.samples[-1]
+        self.drift = self._fit_drift()
+
+    def to_node(self, local):
+        '''convert a time.time() timestamp on our clock to the node's clock'''
+        return local + self.offset + self.drift * (local - self.reference)
+
+    def to_local(self, node):
+        '''convert a timestamp from the node's clock to ours'''
+        return (node - self.offset + self.drift * self.reference) / (1 + self.drift)
+
+
+class ClockSync(object):
+    '''
+    keeps a ClockEstimate for every host by exchanging SyncMessages over the same
+    port 9999 connections the Sender already has open. a round is 'exchanges'
+    exchanges with each host. call sync() to do a round now, or start() to do
+    one every 'interval' seconds in the background.
+    '''
+
+    def __init__(self, sender, hosts, interval=30.0, exchanges=4, window=8):
+        self.sender = sender
+        self.hosts = hosts
+        self.interval = interval
+        self.exchanges = exchanges
+        self.logger = self._initialize_logger()
+        self.estimates = {host: ClockEstimate(window=window) for host in hosts}
+
+    def _initialize_logger(self):
+        logger = logging.getLogger('clocksync')
+        logger.info('clocksync logger instantiated')
+
+        return logger
+
+    def _exchange(self, host):
+        t0 = time.time()
+        reply = self.sender.request(host, SyncMessage(t0).msg)
+        t3 = time.time()
+
+        return self.estimates[host].add(t0, reply['received'], reply['sent'], t3)
+
+    def sync_host(self, host):
+        '''do a round of exchanges with one host, returns False if the host couldn't be reached'''
+        estimate = self.estimates[host]
+
+        try:
+            for i in range(self.exchanges):
+                self._exchange(host)
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning('unable to sync clock with host {}: {}'.format(host, e))
+            return False
+        finally:
+            estimate.commit()
+
+        self.logger.info('host {} clock offset {:+.6f}s, drift {:+.2f}ppm, rtt {:.6f}s'.format(host, estimate.offset, estimate.drift * 1e6, estimate.rtt))
+
+        return True
+
+    def sync(self):
+        for host in self.hosts:
+            self.sync_host(host)
+
+    def _run(self):
+        while True:
+            self.sync()
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self._run, name='clocksync', daemon=True).start()
+
+    def to_node(self, host, local):
+        '''convert a local time.time() deadline into the host's time'''
+        return self.estimates[host].to_node(local)
+
+    def to_local(self, host, node):
+        return self.estimates[host].to_local(node)
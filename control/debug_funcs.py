@@ -3,28 +3,37 @@
 # 6/18/18
 # updated: 6/18/18
 
+import os
+import sys
 import time
-from send import NodeMessage, Sender
-sender = Sender('debug')
 
-host_arm_map = {
-    'murmur01': ['A', 'B', 'C'],
-    'murmur02': ['D', 'E', 'F'],
-    'murmur03': ['G', 'H', 'J'],
-    'murmur04': ['K', 'L', 'M']
-}
+# the modules shared with the nodes are at the top of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from send import BatchMessage, FleetMessage, NodeMessage, Sender
+from topology import load_topology
+from shadow import request_invalidate
+sender = Sender('debug', binary=False, multicast=True)
+topology = load_topology()
 
 
 def get_host_by_arm(arm):
-    for host in host_arm_map:
-        if arm in host_arm_map[host]:
-            return host
+    return topology.arm_hosts.get(arm)
 
 
 def _listify(arms):
     return [arms] if type(arms) is not list else arms
 
 
+def invalidate(arms=None):
+    '''
+    tell the running control program to forget what it thinks arms, or every arm
+    if none are given, are set to, so its next commands to them aren't skipped.
+    the functions below call this for the arms they change.
+    '''
+    request_invalidate(_listify(arms) if arms else None)
+
+
 def _move_mids(arms, direction=None):
     if not direction or direction not in ['raise', 'drop']:
         print('please specify a valid direction')
@@ -34,9 +43,14 @@ def _move_mids(arms, direction=None):
     activate = [False, True]
     arms = _listify(arms)
 
+    # send both mid changes as one batch, with a slight pause on the node
+    # in between to ensure both mid valves are never open simultaneously
     for arm in arms:
-        for action in zip(actuators, activate):
-            fire(arm, action)
+        steps = [(arm, actuator, act, 0.1) for actuator, act in zip(actuators, activate)]
+        msg = BatchMessage(steps)
+        sender.send_msg(topology.address(get_host_by_arm(arm)), msg.msg)
+
+    invalidate(arms)
 
 
 def raise_mid(arms):
@@ -58,6 +72,22 @@ def fire(arms, action, pause=0.1):
 
     for arm in arms:
         msg = NodeMessage(arm, action[0], action[1])
-        host = '{}.local'.format(get_host_by_arm(arm))
+        host = topology.address(get_host_by_arm(arm))
         sender.send_msg(host, msg.msg)
         time.sleep(pause)
+
+    invalidate(arms)
+
+
+def fire_all(action):
+    '''
+    fire the same action on every arm at once, e.g. fire_all(('low', False)).
+    goes out as a single multicast datagram, falling back to one message per arm
+    if it can't be sent that way.
+    '''
+    arms = topology.arms
+
+    if sender.broadcast(FleetMessage([(arm, action[0], action[1]) for arm in arms])):
+        invalidate()
+    else:
+        fire(arms, action, pause=0)
@@ -26,6 +26,12 @@ there are 4 modules that work together to construct the sequence to run:
   that is not the currently running sequence, we break out of the current sequence
   and start executing the new one. run_sequence() actually loops over the generator
   function timer.run() to get events and then sends them to the listening nodes.
+
+after every step that's sent, where we are in the sequence and the state of every
+actuator is checkpointed to checkpoint.json. if control is restarted with --resume
+it puts the nodes back in the checkpointed state and carries on with the sequence
+from the step after the last one that was sent, instead of waiting for the
+touchscreen and starting over.
 '''
 
 
@@ -35,18 +41,27 @@ import time
 import yaml
 import socket
 import logging
+import argparse
 import logging.config
-from timer import Anchorage, Timer
-from send import NodeMessage, Sender
+from functools import partial
+from datetime import datetime
+
+# topology.py, metrics.py, logqueue.py and journal.py are shared with the nodes, at the top of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from timer import Anchorage, Clock, ScaledClock, Timer, VirtualClock
+from send import BatchMessage, CueMessage, FleetMessage, Sender, UploadMessage
 from watchdog import Watchdog
+from clocksync import ClockSync
+from metrics import Metrics
+from topology import load_topology
+from shadow import Shadow
+from checkpoint import Checkpoint
+from logqueue import install_queue
+from journal import Journal
 
 
-host_arm_map = {
-    'murmur01': ['A', 'B', 'C'],
-    'murmur02': ['D', 'E', 'F'],
-    'murmur03': ['G', 'H', 'J'],
-    'murmur04': ['K', 'L', 'M']
-}
+host_arm_map = load_topology().host_arm_map
 
 
 def _get_logfile_name(basepath, hostname):
@@ -71,10 +86,18 @@ def get_hostname():
     return socket.gethostname().split('.')[0]
 
 
-def get_host_by_arm(arm):
-    for host in host_arm_map:
-        if arm in host_arm_map[host]:
-            return host
+def load_addresses(basepath):
+    '''
+    optional addresses.yaml next to this module maps node hostnames to addresses,
+    e.g. "murmur01.local: 192.168.1.101", to pre-seed the Sender's resolver cache
+    '''
+    path = os.path.join(basepath, 'addresses.yaml')
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, 'r') as addresses:
+        return yaml.safe_load(addresses) or {}
 
 
 def configure_logger(basepath, hostname):
@@ -83,6 +106,7 @@ def configure_logger(basepath, hostname):
 
     log_config['handlers']['file']['filename'] = _get_logfile_name(basepath, hostname)
     logging.config.dictConfig(log_config)
+    install_queue(log_config)
     logging.info('* * * * * * * * * * * * * * * * * * * *')
     logging.info('logging configured')
 
@@ -91,6 +115,11 @@ def configure_logger(basepath, hostname):
 
 def quit():
     logger.info('quitting program...')
+
+    if checkpoint:
+        checkpoint.flush()
+
+    sender.close()
     sys.exit()
 
 
@@ -99,7 +128,132 @@ def sleep():
     time.sleep(10)
 
 
-def run_sequence(watchdog, sequence_list):
+def send_cue(cue):
+    '''send a cue to every node, used for 'pause', 'resume' and 'stop' when running resident'''
+    msg = CueMessage(cue)
+
+    for host, result in sender.send_many([(host, msg.msg) for host in timer.hosts]).items():
+        if result.error:
+            logger.error("unable to send '{}' cue to host {}: {}".format(cue, host, result.error))
+
+
+def run_resident(sequence):
+    '''
+    used in place of timer.run() when sequences run on the nodes themselves.
+    the first event is the upload of each node's slice of the sequence followed
+    by a 'start' cue with a shared start time cue_lead seconds from now, converted
+    to each node's clock. after that we only follow along with the schedule to
+    watch for state changes.
+    '''
+    timeline = timer.timelines[sequence]
+    at = time.time() + cue_lead
+    commands = []
+
+    for i, host in enumerate(timeline.host_names):
+        commands.append((host, UploadMessage(sequence, timeline.get_host_steps(i)).msg))
+        commands.append((host, CueMessage('start', sequence=sequence, at=clock.to_node(host, at)).msg))
+
+    yield commands
+    yield from timer.follow(sequence, start=datetime.fromtimestamp(at))
+
+
+def get_fleet_message(event):
+    '''
+    returns the event as a single FleetMessage if it changes arms on more than one
+    node at the same moment and only sets states, e.g. the steps of 'close' or
+    'release_all_mids' when arms aren't staggered. returns None for anything else,
+    which has to go over TCP.
+    '''
+    if len(set(host for host, _ in event)) < 2:
+        return None
+
+    changes = []
+
+    for _, msg in event:
+        if not isinstance(msg, BatchMessage) or msg.at is not None or msg.body is None:
+            return None
+
+        changes.extend((arm, actuator, activate) for arm, actuator, activate, _ in msg.steps)
+
+    return FleetMessage(changes)
+
+
+def mark_reconnected(host):
+    '''called by the sender whenever it opens a connection, the node may have restarted'''
+    reconnected.add(host)
+
+
+def mark_disconnected(host):
+    '''called by the sender when a connection drops, what the node is set to is unknown until it's resynchronised'''
+    shadow.lose(host)
+
+
+def get_resync_commands():
+    '''one batch with the full expected state for every host that reconnected since the last event'''
+    commands = []
+
+    while reconnected:
+        host = reconnected.pop()
+        steps = shadow.get_host_state(host)
+
+        if steps:
+            logger.info('resynchronising host {} with {} expected actuator states'.format(host, len(steps)))
+            commands.append((host, BatchMessage(steps)))
+
+    return commands
+
+
+def get_changes(event):
+    '''drop the commands, and steps of commands, that the shadow says wouldn't change anything'''
+    if send_all:
+        return event
+
+    changes = []
+
+    for host, msg in event:
+        msg = shadow.diff(msg)
+
+        if msg is not None:
+            changes.append((host, msg))
+
+    return changes
+
+
+def send_event(event):
+    '''
+    arms changed by hand since the last event are forgotten (see shadow.py's
+    request_invalidate()), nodes that reconnected are sent their full expected
+    state, then only the
+    commands that change something are sent, and the shadow is updated from the
+    acks. with --multicast, fleet-wide events go out as one multicast datagram,
+    which isn't acked, so the actuators in it are expected but unknown.
+    returns the send_many() results, or an empty dict if nothing was sent over TCP.
+    '''
+    arms = shadow.check_invalidate()
+
+    if arms:
+        logger.info('forgot the actuator states of arms {}, they were changed by hand'.format(', '.join(arms)))
+
+    commands = get_resync_commands() + get_changes(event)
+
+    if not commands:
+        return {}
+
+    fleet = get_fleet_message(commands) if multicast else None
+
+    if fleet is not None and sender.broadcast(fleet):
+        for _, msg in commands:
+            shadow.expect(msg.steps)
+
+        return {}
+
+    results = sender.send_many(commands)
+    shadow.update(commands, results)
+
+    return results
+
+
+def run_sequence(watchdog, sequence_list, resume=None):
     '''
     we use the Watchdog class variable state_maps to break out of the loop
     if necessary: if the state is updated and it's one we're interested in
@@ -113,6 +267,11 @@ def run_sequence(watchdog, sequence_list):
     once the end of the timer.run(sequence) generator object is reached, we return
     the sequence we just ran if it was 'main_loop', otherwise we return None.
     refer to the NOTE below to see how we achieve this after running 'initialize'.
+
+    when running with --resident the nodes run the sequence themselves and the
+    events we get from run_resident() are just the upload and 'start' cue.
+
+    resume is a checkpoint to pick the sequence up from, see resume_sequence().
     '''
 
     # NOTE: we pop 'initialize' off front of copied list so we don't run it again
@@ -120,25 +279,44 @@ def run_sequence(watchdog, sequence_list):
     # 'confirm_blocks_out' sequence list has more than one element in it.
     safe_list = sequence_list[:]
     sequence = safe_list.pop(0) if len(safe_list) > 1 else safe_list[0]
+    host = None
 
     try:
         logger.info("running sequence '{}'".format(sequence))
-        for event in timer.run(sequence):
+
+        if resident:
+            events = run_resident(sequence)
+        elif resume:
+            late = timer.clock.from_real(time.time() - resume['time'])
+            events = timer.run(sequence, resume=resume['offset'], late=late)
+        else:
+            events = timer.run(sequence)
+
+        for event in events:
 
             # refer to docstring for explanation of this block
             if watchdog.check_state() and watchdog.state in watchdog.state_map.keys():
                 if sequence not in watchdog.state_map[watchdog.state]:
                     logger.info("breaking out of sequence '{}'".format(sequence))
+                    if resident:
+                        send_cue('stop')
                     return watchdog.state_map[watchdog.state]
 
             if event:
-                action = event
-                host = '{}.local'.format(get_host_by_arm(action[0]))
-                msg = NodeMessage(*action)
-                sender.send_msg(host, msg.msg)
+                for host, result in send_event(event).items():
+                    if result.error:
+                        raise result.error
+
+                if checkpoint and timer.position:
+                    checkpoint.save(sequence_list, *timer.position, shadow.dump())
 
         logger.info("done running sequence '{}'".format(sequence))
-        return safe_list if 'main_loop' in safe_list else None
+
+        if 'main_loop' in safe_list:
+            return safe_list
+
+        if checkpoint:
+            checkpoint.clear()
 
     except socket.gaierror:
         logger.error('unable to connect to host {}'.format(host))
@@ -147,9 +325,51 @@ def run_sequence(watchdog, sequence_list):
         logger.error('connection refused when trying to send message to host {}'.format(host))
         logger.error('{} is down or possibly not running its main node program'.format(host))
         sleep()
+    except OSError as e:
+        # an ack timeout, a reset connection or an unreachable host
+        logger.error('unable to send message to host {}: {}'.format(host, e))
+        sleep()
 
 
-def run(watchdog):
+def resume_sequence(watchdog, saved):
+    '''
+    pick up a sequence from the checkpoint saved, after control restarted. if the
+    touchscreen is paused we wait for it to carry on, and if it has moved on to a
+    sequence list without the checkpointed sequence in it we don't resume at all.
+    otherwise every node is sent its actuator states from the checkpoint, and the
+    sequence carries on from the step after the last one that was sent.
+    returns the sequence list to run next, like run_sequence().
+    '''
+    while watchdog.state == 'pause':
+        watchdog.wait()
+        watchdog.check_state()
+
+    if saved['sequence'] not in timer.timelines:
+        logger.warning("checkpointed sequence '{}' no longer exists, not resuming".format(saved['sequence']))
+        checkpoint.clear()
+        return None
+
+    if watchdog.state in watchdog.state_map and saved['sequence'] not in watchdog.state_map[watchdog.state]:
+        logger.info("state is {}, not resuming '{}'".format(watchdog.state.upper(), saved['sequence']))
+        checkpoint.clear()
+        return None
+
+    if shadow.restore(saved['states']):
+        reconnected.update(timer.hosts)
+
+        for host, result in send_event([]).items():
+            if result.error:
+                logger.error('unable to resynchronise host {}: {}'.format(host, result.error))
+
+        # the connections opened for that already got the full state
+        reconnected.clear()
+    else:
+        logger.warning('checkpoint is from a different topology, not resynchronising the nodes')
+
+    return run_sequence(watchdog, saved['sequence_list'], resume=saved)
+
+
+def run(watchdog, saved=None):
     '''
     at the top of the loop we wait for a 'start' or 'stop' signal before doing anything.
     on 'start' we run 'initialize' sequence, then run 'main_loop' indefinitely
@@ -159,15 +379,24 @@ def run(watchdog):
     'start' and 'stop' to sequence lists, which are passed to run_sequence
     from here. 'state_maps' is also used in run_sequence to break out of the
     currently running sequence if a state change of 'start' or 'stop' is registered
+
+    saved is a checkpoint to resume from before waiting for the touchscreen.
     '''
 
     while True:
         try:
+            if saved:
+                running = resume_sequence(watchdog, saved)
+                saved = None
+
+                while running:
+                    running = run_sequence(watchdog, running)
+
             # pause at the top of the loop since watchdog._pause() will only run when
             # a state change is registered, and the program starts in state 'pause'
             logger.info('waiting for input from touchscreen...')
             while watchdog.check_state() not in watchdog.state_map.keys():
-                time.sleep(0.1)
+                watchdog.wait()
 
             running = watchdog.state_map[watchdog.state]
 
@@ -181,11 +410,76 @@ def run(watchdog):
             quit()
 
 
+def get_clock(args):
+    '''real time, unless we're rehearsing with --speed or --virtual'''
+    if args.virtual:
+        logger.info('running on a virtual clock, as fast as the nodes take commands')
+        return VirtualClock()
+    elif args.speed != 1.0:
+        logger.info('running {} times faster than real time'.format(args.speed))
+        return ScaledClock(args.speed)
+
+    return Clock()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='murmur control')
+    parser.add_argument('--resident', action='store_true', help='upload sequences to the nodes and only send them cues')
+    parser.add_argument('--multicast', action='store_true', help='send fleet-wide state changes to all nodes at once over UDP multicast')
+    parser.add_argument('--send-all', action='store_true', help="send every command, even when the controller's copy of the state says it changes nothing")
+    parser.add_argument('--metrics-port', type=int, default=9100, help='serve latency histograms on localhost at this port, 0 to disable')
+    parser.add_argument('--metrics-file', help='also write the latency histograms to this file every 30 seconds')
+    parser.add_argument('--cue-lead', type=float, default=0.5, help='seconds between sending a start cue and the shared start time')
+    parser.add_argument('--resume', action='store_true', help='carry on from the last checkpoint instead of waiting for the touchscreen')
+    parser.add_argument('--checkpoint', default=os.path.join(get_basepath(), 'checkpoint.json'), help='where to checkpoint the running sequence')
+    parser.add_argument('--journal', default=os.path.join(get_basepath(), 'journal'), help="directory for the binary journal of every actuator change, '' to disable")
+    parser.add_argument('--speed', type=float, default=1.0, help='run the sequences this many times faster than real time, to rehearse them')
+    parser.add_argument('--virtual', action='store_true', help="run the sequences as fast as possible on a virtual clock, to rehearse them")
+
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        parser.error('--speed has to be more than 0')
+
+    if args.resident and (args.virtual or args.speed != 1.0):
+        parser.error("--speed and --virtual can't be used with --resident, the nodes run the sequence in real time")
+
+    if args.resume and args.resident:
+        parser.error("--resume can't be used with --resident, the nodes run the sequence themselves")
+
+    return args
+
+
 if __name__ == '__main__':
-    logger = configure_logger(get_basepath(current_path=None), get_hostname())
+    args = parse_args()
+    resident = args.resident
+    cue_lead = args.cue_lead
+    multicast = args.multicast
+    send_all = args.send_all
+    basepath = get_basepath(current_path=None)
+    logger = configure_logger(basepath, get_hostname())
     watchdog = Watchdog()
-    sender = Sender(__name__)
+    shadow = Shadow(load_topology())
+    checkpoint = None if resident else Checkpoint(args.checkpoint)
+    saved = checkpoint.load() if args.resume else None
+    reconnected = set()
+    journal = Journal(args.journal, get_hostname()) if args.journal else None
+    sender = Sender(__name__, addresses=load_addresses(basepath), multicast=multicast, on_connect=mark_reconnected, on_disconnect=mark_disconnected, journal=journal)
     anchor = Anchorage()
-    timer = Timer(timer=anchor)
+    timer = Timer(timer=anchor, host_arm_map=host_arm_map, interrupt=watchdog.changed, clock=get_clock(args))
+    clock = ClockSync(sender, timer.hosts)
+    clock.start()
+    metrics = Metrics(hostport=('localhost', args.metrics_port) if args.metrics_port else None, snapshot=args.metrics_file)
+    metrics.start()
+
+    if resident:
+        logger.info('running sequences resident on the nodes')
+        watchdog.add_callback('pause', partial(send_cue, 'pause'))
+        watchdog.add_callback('resume', partial(send_cue, 'resume'))
+
+    if checkpoint:
+        checkpoint.start()
+
+    watchdog.start()
 
-    run(watchdog)
+    run(watchdog, saved=saved)
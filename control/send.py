@@ -4,8 +4,49 @@
 # updated: 6/17/18
 
 import json
+import time
+import random
 import socket
+import select
 import logging
+import itertools
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from metrics import registry
+from protocol import (PROTOCOL_VERSION, BATCH_MAGIC, TIMED_BATCH_MAGIC, ACK_MAGIC, FLEET_MAGIC, BATCH_HEADER, TIMED_BATCH_HEADER,
+                      FLEET_HEADER, ENTRY, ACK, ACTIVATE, MULTICAST_GROUP, MULTICAST_PORT, ack_statuses)
+from logqueue import Lazy
+from journal import status_codes
+from topology import load_topology
+
+
+connect_seconds = registry.histogram('murmur_connect_seconds', 'time to open a connection to a node, including the protocol hello')
+ack_seconds = registry.histogram('murmur_ack_seconds', "time from sending a command to a node until it was acknowledged, per host and the command's actuator")
+
+# ids follow the order of topology.yaml, so they're the same on both ends. ids
+# are a single byte, messages for arms past the first 256 always go out as json
+topology = load_topology()
+arm_ids = {arm: i for arm, i in topology.arm_ids.items() if i < 256}
+actuator_ids = {actuator: i for i, actuator in enumerate(topology.actuators)}
+
+
+def encode_msg(msg):
+    '''messages are sent over the wire as newline delimited, utf-8 encoded strings'''
+    return '{}\r\n'.format(msg).encode()
+
+
+def describe(msg):
+    '''the json of an encoded message or a message object, for logging'''
+    return msg.decode().strip() if isinstance(msg, bytes) else msg.msg
+
+
+def pack_entry(arm, actuator, activate):
+    '''returns None for arms or actuators the binary protocol has no id for, they go out as json'''
+    if arm not in arm_ids or actuator not in actuator_ids:
+        return None
+
+    return ENTRY.pack(arm_ids[arm], actuator_ids[actuator], ACTIVATE if activate else 0)
 
 
 class NodeMessage(object):
@@ -18,6 +59,8 @@ class NodeMessage(object):
         'actuator': 'low',
         'activate': True
     }
+
+    on a binary connection it is sent as a batch frame with a single entry.
     '''
 
     def __init__(self, arm, actuator, activate):
@@ -25,6 +68,8 @@ class NodeMessage(object):
         self.actuator = actuator
         self.activate = activate
         self.msg = self._package_msg()
+        self.encoded = encode_msg(self.msg)
+        self.body = pack_entry(arm, actuator, activate)
 
     def _package_msg(self):
         msg = {
@@ -35,13 +80,785 @@ class NodeMessage(object):
 
         return json.dumps(msg)
 
+    def pack(self, seq):
+        '''return the message as a binary frame with sequence number seq, or None if it can't be packed'''
+        if self.body is None:
+            return None
+
+        return BATCH_HEADER.pack(BATCH_MAGIC, seq, 1) + self.body
+
+
+class BatchMessage(object):
+    '''
+    ordered list of actuator changes for a node to carry out in one pass.
+    steps should be an iterable of (arm, actuator, activate, delay) tuples, where
+    delay is the number of seconds the node waits after applying that step before
+    applying the next one. the arms can be any of the arms on a single host.
+    if at is given, it's the time on the node's clock to apply the batch at.
+
+    format:
+    msg = {
+        'batch': [
+            {'arm': 'A', 'actuator': 'mid-ext', 'activate': False, 'delay': 0.1},
+            {'arm': 'A', 'actuator': 'mid-retract', 'activate': True, 'delay': 0}
+        ],
+        'at': 1529366400.5
+    }
+
+    the binary frame has no room for delays, so a batch with any delays in it is
+    always sent as json. the json and the binary entries are both encoded up front.
+    '''
+
+    def __init__(self, steps, at=None):
+        self.steps = list(steps)
+        self.at = at
+        self.msg = self._package_msg()
+        self.encoded = encode_msg(self.msg)
+        self.body = self._package_body()
+
+    def _package_msg(self):
+        msg = {
+            'batch': [
+                {'arm': arm, 'actuator': actuator, 'activate': activate, 'delay': delay}
+                for arm, actuator, activate, delay in self.steps
+            ]
+        }
+
+        if self.at is not None:
+            msg['at'] = self.at
+
+        return json.dumps(msg)
+
+    def _package_body(self):
+        if any(delay for _, _, _, delay in self.steps) or len(self.steps) > 255:
+            return None
+
+        entries = [pack_entry(arm, actuator, activate) for arm, actuator, activate, _ in self.steps]
+
+        return None if None in entries else b''.join(entries)
+
+    def pack(self, seq):
+        '''return the message as a binary frame with sequence number seq, or None if it can't be packed'''
+        if self.body is None:
+            return None
+        elif self.at is not None:
+            return TIMED_BATCH_HEADER.pack(TIMED_BATCH_MAGIC, seq, len(self.steps), self.at) + self.body
+        else:
+            return BATCH_HEADER.pack(BATCH_MAGIC, seq, len(self.steps)) + self.body
+
+
+class FleetMessage(object):
+    '''
+    actuator changes for arms on any number of nodes, sent to all of them at once
+    over multicast. changes should be an iterable of (arm, actuator, activate)
+    tuples, each node applies the ones for its own arms in order. only plain state
+    changes fit, there are no delays and no acks, so applying one twice or missing
+    a repeat of one is harmless.
+
+    format (json is only used for logging, it always goes out as a fleet frame):
+    msg = {
+        'fleet': [
+            {'arm': 'A', 'actuator': 'low', 'activate': False},
+            {'arm': 'D', 'actuator': 'low', 'activate': False},
+            ...
+        ]
+    }
+    '''
+
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.msg = self._package_msg()
+        self.body = self._package_body()
+
+    def _package_msg(self):
+        msg = {
+            'fleet': [
+                {'arm': arm, 'actuator': actuator, 'activate': activate}
+                for arm, actuator, activate in self.changes
+            ]
+        }
+
+        return json.dumps(msg)
+
+    def _package_body(self):
+        if len(self.changes) > 255:
+            return None
+
+        entries = [pack_entry(arm, actuator, activate) for arm, actuator, activate in self.changes]
+
+        return None if None in entries else b''.join(entries)
+
+    def pack(self, session, seq):
+        '''return the message as a fleet frame, or None if it can't be packed'''
+        if self.body is None:
+            return None
+
+        return FLEET_HEADER.pack(FLEET_MAGIC, session, seq, len(self.changes)) + self.body
+
+
+class UploadMessage(object):
+    '''
+    one node's slice of a compiled sequence, for the node to run on its own.
+    steps should be a list of (offset, changes) pairs, where offset is seconds from
+    the start of the sequence and changes is a list of (arm, actuator, activate).
+
+    format:
+    msg = {
+        'upload': {
+            'sequence': 'main_loop',
+            'steps': [
+                [2.0, [['A', 'low', True], ['A', 'mid-ext', True]]],
+                ...
+            ]
+        }
+    }
+    '''
+
+    def __init__(self, sequence, steps):
+        self.sequence = sequence
+        self.steps = steps
+        self.msg = self._package_msg()
+
+    def _package_msg(self):
+        msg = {
+            'upload': {
+                'sequence': self.sequence,
+                'steps': self.steps
+            }
+        }
+
+        return json.dumps(msg)
+
+
+class CueMessage(object):
+    '''
+    cue for a node's SequenceRunner. cue is one of 'start', 'pause', 'resume' or
+    'stop'. 'start' also needs the name of an uploaded sequence and the unix
+    timestamp to start it at, which is shared by all nodes.
+
+    format:
+    msg = {
+        'cue': 'start',
+        'sequence': 'main_loop',
+        'at': 1529366400.5
+    }
+    '''
+
+    def __init__(self, cue, sequence=None, at=None):
+        self.cue = cue
+        self.sequence = sequence
+        self.at = at
+        self.msg = self._package_msg()
+
+    def _package_msg(self):
+        msg = {'cue': self.cue}
+
+        if self.sequence is not None:
+            msg['sequence'] = self.sequence
+            msg['at'] = self.at
+
+        return json.dumps(msg)
+
+
+class SyncMessage(object):
+    '''
+    clock sync request. the node answers with its own receive and send times,
+    see ClockSync in clocksync.py.
+
+    format:
+    msg = {
+        'sync': 1529366400.123
+    }
+    '''
+
+    def __init__(self, sent):
+        self.sent = sent
+        self.msg = self._package_msg()
+
+    def _package_msg(self):
+        return json.dumps({'sync': self.sent})
+
+
+class HelloMessage(object):
+    '''
+    sent when a connection is opened, asking the node to use the binary protocol.
+    the node answers with the highest version it supports that isn't higher than
+    ours. a node that doesn't know about hello just sends it back, which means json.
+
+    format:
+    msg = {
+        'hello': 1
+    }
+    '''
+
+    def __init__(self, version):
+        self.version = version
+        self.msg = self._package_msg()
+
+    def _package_msg(self):
+        return json.dumps({'hello': self.version})
+
+
+def get_steps(msg):
+    '''the (arm, actuator, activate, ...) changes in a message object, or None if it has none'''
+    if isinstance(msg, NodeMessage):
+        return [(msg.arm, msg.actuator, msg.activate)]
+
+    return getattr(msg, 'steps', None)
+
+
+def get_actuator(msg):
+    '''
+    the actuator a message changes, to label its ack latency with. 'mixed' if it
+    changes more than one kind of actuator, 'none' if it isn't an actuator change
+    '''
+    steps = get_steps(msg)
+    actuators = set(step[1] for step in steps) if steps else set()
+
+    if len(actuators) > 1:
+        return 'mixed'
+
+    return actuators.pop() if actuators else 'none'
+
+
+class Resolver(object):
+    '''
+    cache of resolved node addresses, so .local names only go through mDNS once
+    instead of on every connect. addresses older than ttl seconds are refreshed
+    in a background thread while the cached address keeps being used, and if a
+    refresh fails we keep the last address that worked. only a host we've never
+    resolved raises socket.gaierror. seed is an optional dict of host -> address
+    to start from, for example read from a config file.
+    '''
+
+    def __init__(self, logger, ttl=300.0, seed=None):
+        self.logger = logger
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.addresses = {}  # host -> (address, time resolved)
+        self.refreshing = set()
+
+        for host, address in (seed or {}).items():
+            self.addresses[host] = (address, time.monotonic())
+
+    def _lookup(self, host):
+        return socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)[0][4][0]
+
+    def _refresh(self, host):
+        try:
+            address = self._lookup(host)
+        except OSError as e:
+            self.logger.warning('unable to refresh address of host {host}, keeping last known good: {e}'.format(host=host, e=e))
+            address = None
+
+        with self.lock:
+            if address:
+                if address != self.addresses[host][0]:
+                    self.logger.info('host {host} moved to {address}'.format(host=host, address=address))
+
+                self.addresses[host] = (address, time.monotonic())
+
+            self.refreshing.discard(host)
+
+    def resolve(self, host):
+        with self.lock:
+            cached = self.addresses.get(host)
+
+            if cached and time.monotonic() - cached[1] > self.ttl and host not in self.refreshing:
+                self.refreshing.add(host)
+                threading.Thread(target=self._refresh, args=(host,), name='resolve', daemon=True).start()
+
+        if cached:
+            return cached[0]
+
+        address = self._lookup(host)
+        self.logger.info('resolved host {host} to {address}'.format(host=host, address=address))
+
+        with self.lock:
+            self.addresses[host] = (address, time.monotonic())
+
+        return address
+
+    def expire(self, host):
+        '''force a refresh the next time host is resolved, e.g. after failing to connect to it'''
+        with self.lock:
+            if host in self.addresses:
+                self.addresses[host] = (self.addresses[host][0], float('-inf'))
+
+
+class Multicaster(object):
+    '''
+    sends FleetMessages to every node at once as UDP multicast datagrams, so a
+    fleet-wide change reaches all arms at the same moment with one packet.
+
+    UDP can drop packets, so each datagram is sent 'copies' times, 'spacing'
+    seconds apart. the first copy goes out right away and the repeats from a timer
+    thread, so the caller isn't held up. every datagram carries this sender's
+    random session id and an increasing sequence number, and the nodes drop any
+    datagram that isn't newer than the last one they applied from the session.
+    that suppresses the repeats, and stops a late repeat of an older message from
+    undoing a newer one.
+
+    interface is the address of the local interface to send from, the default
+    lets the OS pick one from the routing table.
+    '''
+
+    def __init__(self, logger, group=MULTICAST_GROUP, port=MULTICAST_PORT, copies=3, spacing=0.005, interface=None, ttl=1):
+        self.logger = logger
+        self.group = group
+        self.port = port
+        self.copies = copies
+        self.spacing = spacing
+        self.interface = interface
+        self.ttl = ttl
+        self.session = random.getrandbits(32)
+        self.seq = 0
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+
+        if self.interface:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+
+        self.logger.info('opened multicast socket for group {group}:{port}'.format(group=self.group, port=self.port))
+
+        return sock
+
+    def _sendto(self, frame):
+        try:
+            self.sock.sendto(frame, (self.group, self.port))
+        except (OSError, AttributeError) as e:
+            self.logger.error('unable to send multicast datagram: {}'.format(e))
+
+    def send(self, msg):
+        '''
+        send a FleetMessage, returns False if it can't be packed into a fleet frame
+        or the datagram can't be sent, e.g. when there's no route for multicast
+        '''
+        with self.lock:
+            frame = msg.pack(self.session, (self.seq + 1) & 0xFFFFFFFF)
+
+            if frame is None:
+                return False
+
+            try:
+                if self.sock is None:
+                    self.sock = self._open()
+
+                self.sock.sendto(frame, (self.group, self.port))
+            except OSError as e:
+                self.logger.error('unable to send multicast datagram, falling back to tcp: {}'.format(e))
+                return False
+
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+
+        for i in range(1, self.copies):
+            repeat = threading.Timer(i * self.spacing, self._sendto, args=(frame,))
+            repeat.daemon = True
+            repeat.start()
+
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+
+class Connection(object):
+    '''
+    long-lived TCP connection to a single node's receive server.
+
+    the socket is opened lazily on the first request and then reused for every
+    message sent to that host. before each request we check that the node hasn't
+    closed its end, and if a send fails on a stale socket we reconnect once and
+    try again. connection errors (socket.gaierror, ConnectionRefusedError) on a
+    fresh connect are raised to the caller so main.py can handle them as before.
+    requests are serialised with a lock, since the send_many() workers, clock
+    sync and watchdog callbacks can all share one connection.
+
+    on a binary connection send() doesn't wait for each acknowledgement. up to
+    'window' frames can be in flight, and the node acks each one with its
+    sequence number and a status once it has been applied. if an ack doesn't
+    arrive within ack_timeout, or the connection drops, we reconnect and resend
+    everything still in flight in its original order, up to max_retries times.
+    the commands only set actuator states, so applying one twice is harmless.
+    json messages are still sent one at a time and acked by echoing them back.
+
+    on_connect is called with the host whenever a connection is opened, and
+    on_disconnect whenever one drops or goes stale, but not when it's closed
+    for being idle.
+    '''
+
+    def __init__(self, host, port, logger, resolver, connect_timeout=5.0, ack_timeout=5.0, binary=False, window=8, max_retries=2, on_connect=None, on_disconnect=None):
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.resolver = resolver
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.binary = binary
+        self.window = window
+        self.max_retries = max_retries
+        self.protocol = 0  # 0 is json, otherwise the negotiated binary protocol version
+        self.seq = 0
+        self.connect_timeout = connect_timeout
+        self.ack_timeout = ack_timeout
+        self.sock = None
+        self.buffer = b''
+        self.lost = False  # on_disconnect was called for the last connection and it hasn't been reopened
+        self.lock = threading.Lock()
+        self.tokens = itertools.count()
+        self.inflight = OrderedDict()  # seq -> [token, msg, time sent, retries]
+        self.results = {}  # token -> (status, latency in seconds, seq or 0 for json)
+        self.last_used = time.monotonic()
+
+    def _connect(self):
+        address = self.resolver.resolve(self.host)
+        self.logger.info('opening connection to host {host} at {address}'.format(host=self.host, address=address))
+        started = time.monotonic()
+
+        try:
+            sock = socket.create_connection((address, self.port), timeout=self.connect_timeout)
+        except OSError:
+            # the node may have come back with a different address
+            self.resolver.expire(self.host)
+            raise
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.settimeout(self.ack_timeout)
+        self.sock = sock
+        self.buffer = b''
+        self.lost = False
+        self.protocol = self._negotiate() if self.binary else 0
+        connect_seconds.observe(time.monotonic() - started, host=self.host)
+
+        if self.on_connect:
+            self.on_connect(self.host)
+
+    def _negotiate(self):
+        reply = self._exchange(encode_msg(HelloMessage(PROTOCOL_VERSION).msg))
+
+        try:
+            version = int(json.loads(reply.decode())['hello'])
+        except (ValueError, KeyError, TypeError):
+            version = 0
+
+        version = version if 0 < version <= PROTOCOL_VERSION else 0
+        self.logger.info('host {host} using {protocol}'.format(host=self.host, protocol='binary protocol v{}'.format(version) if version else 'json'))
+
+        return version
+
+    def _healthy(self):
+        '''
+        a socket with nothing to read is healthy. if select says it is readable
+        the node either sent an ack we haven't read yet, or closed the
+        connection, in which case peeking returns nothing.
+        '''
+
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                return True
+
+            return self.sock.recv(1, socket.MSG_PEEK) != b''
+        except (OSError, ValueError):
+            return False
+
+    def _read_line(self):
+        '''acknowledgements are newline delimited, and may arrive split across packets'''
+
+        while b'\n' not in self.buffer:
+            data = self.sock.recv(4096)
+
+            if not data:
+                raise ConnectionResetError('host {} closed the connection'.format(self.host))
+
+            self.buffer += data
+
+        line, self.buffer = self.buffer.split(b'\n', 1)
+
+        return line + b'\n'
+
+    def _read_exactly(self, size):
+        while len(self.buffer) < size:
+            data = self.sock.recv(4096)
+
+            if not data:
+                raise ConnectionResetError('host {} closed the connection'.format(self.host))
+
+            self.buffer += data
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+    def _exchange(self, encoded):
+        '''send a json message and wait for it to be echoed back'''
+        self.sock.sendall(encoded)
+
+        return self._read_line()
+
+    def _encode(self, msg):
+        '''
+        msg is either already encoded bytes, or a message object. message objects
+        are packed into a binary frame if this connection negotiated one and the
+        message can be packed, otherwise we use their json encoding. returns a
+        tuple of (encoded, seq), where seq is None for json.
+        '''
+        if isinstance(msg, bytes):
+            return msg, None
+
+        if self.protocol and hasattr(msg, 'pack'):
+            seq = (self.seq + 1) & 0xFFFF
+            frame = msg.pack(seq)
+
+            if frame is not None:
+                self.seq = seq
+                return frame, seq
+
+        return msg.encoded, None
+
+    def _ensure_connected(self):
+        '''returns True if we had to open a new connection'''
+        if self.sock is not None and not self._healthy():
+            self.logger.warning('connection to host {host} went stale, reconnecting'.format(host=self.host))
+            self._lose()
+
+        if self.sock is None:
+            self._connect()
+            return True
+
+        return False
+
+    def _transmit(self, token, msg, retries):
+        '''send one message, either into the in-flight window or as a json exchange'''
+        encoded, seq = self._encode(msg)
+        sent = time.monotonic()
+
+        if seq is None:
+            # the echo only says the node got the message, not what it made of it
+            self._drain()
+            data = self._exchange(encoded)
+            self.results[token] = ('received' if data == encoded else None, time.monotonic() - sent, 0)
+            ack_seconds.observe(self.results[token][1], host=self.host, actuator=get_actuator(msg))
+        else:
+            # register the frame before sending it, so it's resent if the send fails
+            self.inflight[seq] = [token, msg, sent, retries]
+            self.sock.sendall(encoded)
+
+    def _resend(self, reason):
+        '''reconnect and send everything still in flight again, in order'''
+        pending = list(self.inflight.values())
+        self.inflight.clear()
+        self._lose()
+
+        if any(retries >= self.max_retries for _, _, _, retries in pending):
+            raise socket.timeout('host {} did not acknowledge after {} retries'.format(self.host, self.max_retries))
+
+        self.logger.warning('{reason} from host {host}, resending {n} messages'.format(reason=reason, host=self.host, n=len(pending)))
+        self._connect()
+
+        for token, msg, _, retries in pending:
+            self._transmit(token, msg, retries + 1)
+
+    def _read_ack(self):
+        '''wait for the next ack frame and record the result for its message'''
+        try:
+            magic, seq, status = ACK.unpack(self._read_exactly(ACK.size))
+        except socket.timeout:
+            self._resend('ack timed out')
+            return
+        except (BrokenPipeError, ConnectionResetError):
+            self._resend('lost connection')
+            return
+
+        if magic != ACK_MAGIC:
+            raise ConnectionError('host {} sent an invalid acknowledgement'.format(self.host))
+
+        entry = self.inflight.pop(seq, None)
+
+        if entry is None:
+            self.logger.warning('host {host} acknowledged unknown sequence number {seq}'.format(host=self.host, seq=seq))
+            return
+
+        token, msg, sent, _ = entry
+        self.results[token] = (ack_statuses.get(status, 'unknown status'), time.monotonic() - sent, seq)
+        ack_seconds.observe(self.results[token][1], host=self.host, actuator=get_actuator(msg))
+
+    def _drain(self):
+        while self.inflight:
+            self._read_ack()
+
+    def close_if_idle(self, idle_timeout):
+        '''close the socket if it hasn't been used for idle_timeout seconds, returns True if closed'''
+
+        # a connection that's busy with a request isn't idle
+        if not self.lock.acquire(blocking=False):
+            return False
+
+        try:
+            if self.sock is not None and not self.inflight and time.monotonic() - self.last_used > idle_timeout:
+                self.close()
+                return True
+
+            return False
+        finally:
+            self.lock.release()
+
+    def _lose(self):
+        '''close a connection that dropped, the node may have restarted since'''
+        self.close()
+        self.lost = True
+
+        if self.on_disconnect:
+            self.on_disconnect(self.host)
+
+    def close(self):
+        if self.sock is not None:
+            self.logger.debug('closing connection to host {host}'.format(host=self.host))
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+    def send(self, msg):
+        '''
+        send a message without waiting for its ack if it goes out as a binary frame.
+        returns a token to look up the result with pop_result() after flush().
+        '''
+        with self.lock:
+            token = next(self.tokens)
+
+            fresh = self._ensure_connected()
+
+            try:
+                while len(self.inflight) >= self.window:
+                    self._read_ack()
+
+                self._transmit(token, msg, 0)
+            except (BrokenPipeError, ConnectionResetError, socket.timeout):
+                if self.inflight:
+                    self._resend('lost connection')
+                elif fresh:
+                    self._lose()
+                    raise
+                else:
+                    # a json message on a connection that dropped, try once more
+                    self._lose()
+                    self.logger.warning('lost connection to host {host}, reconnecting'.format(host=self.host))
+                    self._connect()
+                    self._transmit(token, msg, 0)
+
+            self.last_used = time.monotonic()
+
+            return token
+
+    def flush(self):
+        '''wait until every message in flight has been acknowledged'''
+        with self.lock:
+            self._drain()
+            self.last_used = time.monotonic()
+
+    def pop_result(self, token):
+        '''return (status, latency, seq) for a sent message, or None if it never completed'''
+        return self.results.pop(token, None)
+
+    def request(self, msg):
+        '''
+        send a message and wait for the node's reply, returning a tuple of
+        (what we sent, the node's reply). used for json messages.
+        '''
+
+        with self.lock:
+            return self._request(msg)
+
+    def _request(self, msg):
+        fresh = self._ensure_connected()
+
+        try:
+            self._drain()
+            encoded, _ = self._encode(msg)
+            data = self._exchange(encoded)
+        except (BrokenPipeError, ConnectionResetError, socket.timeout):
+            self._lose()
+
+            # a brand new connection failing is a real problem, let the caller handle it
+            if fresh:
+                raise
+
+            self.logger.warning('lost connection to host {host}, reconnecting'.format(host=self.host))
+            try:
+                self._connect()
+                encoded, _ = self._encode(msg)
+                data = self._exchange(encoded)
+            except OSError:
+                self.close()
+                raise
+
+        self.last_used = time.monotonic()
+
+        return encoded, data
+
 
 class Sender(object):
-    '''class to handle sending client socket messages to listening servers'''
+    '''
+    class to handle sending client socket messages to listening servers.
+
+    we keep a pool of Connection objects, one per host, so consecutive messages
+    to the same node reuse one TCP connection instead of paying for a new
+    handshake (and .local name resolution) every time. connections that haven't
+    been used for idle_timeout seconds are closed the next time we send.
+
+    send_many() fans commands for different hosts out over a small thread pool,
+    so one slow node doesn't hold up the others. each host is handled by a
+    single worker, which keeps the order of that host's commands intact.
+
+    node addresses are resolved once through a Resolver and cached, 'addresses'
+    can pre-seed it with a dict of host -> address.
+
+    if binary is True each connection offers the node the binary protocol, and
+    NodeMessages and BatchMessages are sent as compact frames where it's accepted.
+    strings are always sent as json, which is what debug_funcs.py uses.
+
+    on_connect is called with the host every time a connection to it is opened,
+    main.py uses it to notice a node may have restarted and resynchronise it.
+    on_disconnect is called with the host when a connection to it drops or
+    sending to it fails. both are called from whichever thread is sending, so
+    they shouldn't block.
+
+    if multicast is True, broadcast() sends FleetMessages to every node at once
+    over UDP multicast, see Multicaster. commands that need an ack still go over
+    TCP with send_many().
 
-    def __init__(self, calling_module):
+    if a Journal is given, every actuator change sent with send_many() or
+    broadcast() is recorded in it, with its ack status and latency.
+    '''
+
+    port = 9999
+    HostResult = namedtuple('HostResult', ['host', 'statuses', 'latencies', 'error'])
+
+    def __init__(self, calling_module, idle_timeout=60.0, max_workers=8, binary=True, window=8, ack_timeout=5.0, addresses=None, multicast=False, on_connect=None, on_disconnect=None, journal=None):
         self.calling_module = calling_module
+        self.idle_timeout = idle_timeout
+        self.max_workers = max_workers
+        self.binary = binary
+        self.window = window
+        self.ack_timeout = ack_timeout
         self.logger = self._initialize_logger()
+        self.resolver = Resolver(self.logger, seed=addresses)
+        self.multicaster = Multicaster(self.logger) if multicast else None
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.journal = journal
+        self.lock = threading.Lock()  # guards self.connections when send_many() workers are running
+        self.connections = {}
+        self.executor = None
 
     def _initialize_logger(self):
         logger = logging.getLogger('send')
@@ -50,22 +867,191 @@ class Sender(object):
         return logger
 
     def _encode_msg(self, msg):
-        return '{}\r\n'.format(msg).encode()
+        return encode_msg(msg)
+
+    def _get_connection(self, host):
+        with self.lock:
+            if host not in self.connections:
+                self.connections[host] = Connection(
+                    host, self.port, self.logger, self.resolver, ack_timeout=self.ack_timeout, binary=self.binary, window=self.window,
+                    on_connect=self.on_connect, on_disconnect=self.on_disconnect
+                )
+
+            return self.connections[host]
+
+    def _drop_connection(self, host):
+        '''forget a host's connection after an error, on_disconnect is called unless the connection already did'''
+        with self.lock:
+            connection = self.connections.pop(host, None)
+
+        if connection:
+            connection.close()
+
+        if self.on_disconnect and not (connection and connection.lost):
+            self.on_disconnect(host)
+
+    def _close_idle(self):
+        with self.lock:
+            for host, connection in self.connections.items():
+                if connection.close_if_idle(self.idle_timeout):
+                    self.logger.info('closed connection to host {host}, idle for over {timeout} seconds'.format(host=host, timeout=self.idle_timeout))
+
+    def _get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='send')
+
+        return self.executor
 
     def _tcp_client_send(self, host, msg):
-        '''hostport in client.connect() should be a tuple formatted (host, port)'''
-        hostport = (host, 9999)
-        encoded = self._encode_msg(msg)
+        '''msg is bytes or a message object, returns True if the host acknowledged it'''
+
+        try:
+            encoded, data = self._get_connection(host).request(msg)
+        except OSError:
+            self._drop_connection(host)
+            raise
+
+        acked = data == encoded
+
+        if acked:
+            self.logger.info('host %s acknowledged message was received', host)
+
+        return acked
+
+    def _send_host(self, host, msgs):
+        '''
+        send a list of messages to one host in order, keeping up to the connection's
+        window of them in flight, then wait for all of their acks. we stop at the
+        first error, since the rest of that host's commands were meant to follow it.
+        '''
+        connection = self._get_connection(host)
+        tokens = []
+        error = None
+
+        try:
+            for msg in msgs:
+                self.logger.info('sending message "%s" to host %s', Lazy(describe, msg), host)
+                tokens.append(connection.send(msg))
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-            client.connect(hostport)
-            client.sendall(encoded)
+            connection.flush()
+        except OSError as e:
+            self.logger.error('error sending to host {host}: {e}'.format(host=host, e=e))
+            self._drop_connection(host)
+            error = e
+        finally:
+            # pop every result, even past the first missing one, so none are left behind on the connection
+            results = [connection.pop_result(token) for token in tokens]
 
-            data = client.recv(1024)
+        statuses = []
+        latencies = []
+        seqs = []
 
-            if data == encoded:
-                self.logger.info('host {host} acknowledged message was received'.format(host=host))
+        for result in results:
+            if result is None:
+                break
+
+            statuses.append(result[0])
+            latencies.append(result[1])
+            seqs.append(result[2])
+
+            if result[0] not in ('applied', 'received', 'scheduled'):
+                self.logger.warning('host {host} reported {status}'.format(host=host, status=result[0]))
+
+        if self.journal is not None:
+            self._journal(msgs, statuses, latencies, seqs)
+
+        return self.HostResult(host, statuses, latencies, error)
+
+    def _journal(self, msgs, statuses, latencies, seqs):
+        '''record the changes in one host's messages, the ones that never got a known ack are 'unacked' '''
+        for i, msg in enumerate(msgs):
+            steps = get_steps(msg)
+
+            if not steps:
+                continue
+
+            if i < len(statuses) and statuses[i] in status_codes:
+                self.journal.record(steps, statuses[i], seq=seqs[i], latency=latencies[i])
+            else:
+                self.journal.record(steps, 'unacked')
 
     def send_msg(self, host, msg):
-        self.logger.info('sending message "{msg}" to host {host}'.format(msg=msg, host=host))
-        self._tcp_client_send(host, msg)
+        self.logger.info('sending message "%s" to host %s', msg, host)
+        self._close_idle()
+        self._tcp_client_send(host, self._encode_msg(msg))
+
+    def request(self, host, msg):
+        '''send a message and return the node's reply decoded from json, used for clock sync'''
+        self._close_idle()
+
+        try:
+            _, data = self._get_connection(host).request(self._encode_msg(msg))
+        except OSError:
+            self._drop_connection(host)
+            raise
+
+        return json.loads(data.decode())
+
+    def send_many(self, commands):
+        '''
+        commands should be an iterable of (host, msg) tuples, where msg is either a
+        string, an already encoded message, or a message object with a pack() method
+        such as BatchMessage, which can go out as a binary frame. commands for different hosts are sent
+        in parallel, commands for the same host are sent in the order given.
+
+        returns a dict of host -> HostResult(host, statuses, latencies, error), where
+        statuses and latencies (in seconds, from send to ack) line up with the commands
+        sent to that host and error is the exception that stopped sending to the host,
+        if any. a status is 'received' for a json message the node echoed back,
+        otherwise it is the status the node acked the frame with, see ack_statuses.
+        the node echoes json before it handles the message, so 'received' doesn't
+        say whether it was applied, rejected or for an unknown actuator.
+        '''
+        by_host = {}
+
+        for host, msg in commands:
+            by_host.setdefault(host, []).append(self._encode_msg(msg) if isinstance(msg, str) else msg)
+
+        self._close_idle()
+
+        if len(by_host) == 1:
+            host, msgs = by_host.popitem()
+            return {host: self._send_host(host, msgs)}
+
+        executor = self._get_executor()
+        futures = {host: executor.submit(self._send_host, host, msgs) for host, msgs in by_host.items()}
+
+        return {host: future.result() for host, future in futures.items()}
+
+    def broadcast(self, msg):
+        '''
+        send a FleetMessage to every node over multicast. returns False if multicast
+        isn't enabled or the message can't be packed or sent, so the caller can fall back
+        to sending it over TCP.
+        '''
+        if self.multicaster is None:
+            return False
+
+        self.logger.info('broadcasting message "%s"', msg.msg)
+        sent = self.multicaster.send(msg)
+
+        if sent and self.journal is not None:
+            self.journal.record(msg.changes, 'broadcast', seq=self.multicaster.seq)
+
+        return sent
+
+    def close(self):
+        '''close every pooled connection and shut down the send_many() workers'''
+
+        with self.lock:
+            for connection in self.connections.values():
+                connection.close()
+
+            self.connections.clear()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+        if self.multicaster is not None:
+            self.multicaster.close()
@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+# murmur - the controller's copy of every actuator's state
+# 10/18/26
+
+import os
+import threading
+from array import array
+from send import BatchMessage
+
+
+def get_basepath():
+    return os.path.dirname(os.path.realpath(__file__))
+
+
+invalidate_file = os.path.join(get_basepath(), 'invalidate.txt')
+
+
+def request_invalidate(arms=None, path=invalidate_file):
+    '''
+    ask the running control program to forget what it knows about arms, or about
+    every arm, e.g. after changing them by hand from debug_funcs.py. the arms are
+    appended to path, which Shadow.check_invalidate() picks up before the next event.
+    '''
+    with open(path, 'a') as requests:
+        requests.write(''.join('{}\n'.format(arm) for arm in arms) if arms else '*\n')
+
+
+class Shadow(object):
+    '''
+    what the controller believes every actuator on every node is set to, kept in
+    flat arrays with one slot per (arm, actuator), indexed like the topology:
+    slot = arm id * number of actuators + actuator id. a slot is 1 or 0, or -1
+    while it's unknown.
+
+    'states' is what the nodes have acknowledged applying, and it's what diff()
+    goes by. 'expected' is what they were last told, which is what a node is
+    put back to when it reconnects and what's checkpointed. the two only differ
+    after changes that weren't acked, like multicast datagrams, or a dropped
+    connection, which makes a host's states unknown but not its expected ones.
+
+    states never expire on their own. anything that wasn't acked as applied
+    becomes unknown, and so does everything on a host whose connection drops
+    (see lose()) or on arms changed by hand (see request_invalidate()). unknown
+    actuators are always sent.
+
+    diff() drops the steps of a BatchMessage that wouldn't change anything, and
+    get_host_state() gives the expected state of a host's arms, which is sent in
+    one batch to put a node that reconnected back where it was.
+    '''
+
+    def __init__(self, topology, invalidate_file=invalidate_file):
+        self.topology = topology
+        self.invalidate_file = invalidate_file
+        self.actuator_ids = {actuator: i for i, actuator in enumerate(topology.actuators)}
+        self.width = len(topology.actuators)
+        self.states = array('b', [-1] * len(topology.arms) * self.width)
+        self.expected = array('b', [-1] * len(topology.arms) * self.width)
+        self.lock = threading.Lock()
+
+    def _slot(self, arm, actuator):
+        return self.topology.arm_ids[arm] * self.width + self.actuator_ids[actuator]
+
+    def _arm_slots(self, arms):
+        for arm in arms:
+            start = self.topology.arm_ids[arm] * self.width
+            yield from range(start, start + self.width)
+
+    def get(self, arm, actuator):
+        '''returns True or False, or None if the state is unknown'''
+        state = self.states[self._slot(arm, actuator)]
+
+        return bool(state) if state >= 0 else None
+
+    def snapshot(self):
+        '''returns {arm: {actuator: state}}, with None for unknown states, e.g. for the touchscreen'''
+        return {
+            arm: {
+                actuator: bool(self.states[i * self.width + j]) if self.states[i * self.width + j] >= 0 else None
+                for j, actuator in enumerate(self.topology.actuators)
+            }
+            for i, arm in enumerate(self.topology.arms)
+        }
+
+    def dump(self):
+        '''
+        the expected states as a string with one character per slot, '1', '0' or '-'
+        for unknown, compact enough to checkpoint on every step
+        '''
+        with self.lock:
+            return ''.join(str(state) if state >= 0 else '-' for state in self.expected)
+
+    def restore(self, states):
+        '''
+        load expected states from dump(). they only become known states once a node
+        acks them, so the nodes should be resynchronised from get_host_state() next.
+        a dump from a different topology is ignored, and returns False.
+        '''
+        if len(states) != len(self.expected):
+            return False
+
+        with self.lock:
+            for slot, state in enumerate(states):
+                self.expected[slot] = -1 if state == '-' else int(state)
+                self.states[slot] = -1
+
+        return True
+
+    def apply(self, steps):
+        '''record (arm, actuator, activate, ...) steps that a node acknowledged'''
+        with self.lock:
+            for arm, actuator, activate, *_ in steps:
+                slot = self._slot(arm, actuator)
+                self.states[slot] = self.expected[slot] = 1 if activate else 0
+
+    def expect(self, steps):
+        '''record steps that were sent without an ack, e.g. multicast, as expected but unknown'''
+        with self.lock:
+            for arm, actuator, activate, *_ in steps:
+                slot = self._slot(arm, actuator)
+                self.expected[slot] = 1 if activate else 0
+                self.states[slot] = -1
+
+    def forget(self, steps):
+        '''mark the actuators in steps as unknown'''
+        with self.lock:
+            for arm, actuator, *_ in steps:
+                slot = self._slot(arm, actuator)
+                self.states[slot] = self.expected[slot] = -1
+
+    def lose(self, host):
+        '''
+        the connection to host dropped, so the node may have restarted. its states
+        are unknown until it's resynchronised, but what it should be set to is kept.
+        host can be given with or without '.local'.
+        '''
+        with self.lock:
+            for slot in self._arm_slots(self.topology.host_arm_map[host.split('.')[0]]):
+                self.states[slot] = -1
+
+    def invalidate(self, arms=None):
+        '''forget everything about arms, or every arm'''
+        with self.lock:
+            for slot in self._arm_slots(self.topology.arms if arms is None else arms):
+                self.states[slot] = self.expected[slot] = -1
+
+    def check_invalidate(self):
+        '''
+        invalidate the arms asked for with request_invalidate() since the last check.
+        the file is renamed before it's read, so a request made while reading it is
+        left for the next check. returns the arms that were invalidated.
+        '''
+        if self.invalidate_file is None:
+            return []
+
+        taken = '{}.taken'.format(self.invalidate_file)
+
+        try:
+            os.replace(self.invalidate_file, taken)
+        except FileNotFoundError:
+            return []
+
+        with open(taken, 'r') as requests:
+            arms = set(line.strip() for line in requests) - {''}
+
+        os.remove(taken)
+        arms = list(self.topology.arms) if '*' in arms else [arm for arm in self.topology.arms if arm in arms]
+        self.invalidate(arms)
+
+        return arms
+
+    def diff(self, msg):
+        '''
+        returns msg without the steps that set an actuator to the state it's known
+        to be in, or None if nothing is left. batches with delays are returned as
+        they are, since dropping a step would shift the ones after it.
+        '''
+        if not isinstance(msg, BatchMessage) or any(delay for *_, delay in msg.steps):
+            return msg
+
+        steps = []
+
+        for step in msg.steps:
+            state = self.states[self._slot(step[0], step[1])]
+
+            if state < 0 or state != int(bool(step[2])):
+                steps.append(step)
+
+        if len(steps) == len(msg.steps):
+            return msg
+
+        return BatchMessage(steps, at=msg.at) if steps else None
+
+    def get_host_state(self, host):
+        '''
+        the expected states of a host's arms as (arm, actuator, activate, 0) steps,
+        with everything that's off first so the node's mid valve interlock never
+        sees both mids open. host can be given with or without '.local'.
+        '''
+        steps = []
+
+        for arm in self.topology.host_arm_map[host.split('.')[0]]:
+            for actuator in self.topology.actuators:
+                state = self.expected[self._slot(arm, actuator)]
+
+                if state >= 0:
+                    steps.append((arm, actuator, bool(state), 0))
+
+        return sorted(steps, key=lambda step: step[2])
+
+    def update(self, commands, results):
+        '''
+        reconcile the shadow with the results of Sender.send_many(commands). each
+        host's statuses line up with its commands in order. only 'applied' acks make
+        a state known. json messages the node echoed back ('received') and timed
+        batches it scheduled are expected, since the node may still reject them.
+        anything else is forgotten.
+        '''
+        sent = {}
+
+        for host, msg in commands:
+            sent.setdefault(host, []).append(msg)
+
+        for host, msgs in sent.items():
+            statuses = results[host].statuses if host in results else []
+
+            for i, msg in enumerate(msgs):
+                if not hasattr(msg, 'steps'):
+                    continue
+
+                if i < len(statuses) and statuses[i] == 'applied':
+                    self.apply(msg.steps)
+                elif i < len(statuses) and statuses[i] in ('received', 'scheduled'):
+                    self.expect(msg.steps)
+                else:
+                    self.forget(msg.steps)
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# murmur - compile sequences into flat timelines ahead of time
+# 10/18/26
+
+import logging
+from array import array
+from send import BatchMessage
+from topology import load_topology
+
+
+topology = load_topology()
+
+
+class Timeline(object):
+    '''
+    flat, array-backed version of a single sequence from a timer class such as
+    Anchorage, compiled once so running the sequence only has to walk arrays.
+
+    every actuator change is a record, stored column-wise in parallel arrays:
+        offsets[i]    seconds from the start of the sequence
+        hosts[i]      index into self.host_names
+        arms[i]       index into self.arm_names, which is also the arm's id on the wire
+        actuators[i]  index into self.actuator_names
+        activate[i]   1 or 0
+
+    records that fire together on one arm make up a step, which is sent to the
+    node as a single batch. to ensure both mid valves are never open at the same
+    time, any change that follows a mid valve change goes into a new step
+    scheduled mid_delay seconds later, so the scheduler enforces the gap instead
+    of anyone sleeping. step_offsets, step_hosts and step_starts hold each
+    step's offset, host index and the index of its first record, step_actions
+    and step_orders the index of its action in the sequence and of its arm in
+    the action's order, and messages holds the step's BatchMessage, which
+    encodes itself for the wire up front.
+
+    marks is a list of (offset, kind, action) tuples used for logging where
+    actions begin ('fire') and finish ('done'), and duration is the total length
+    of the sequence in seconds, including the final pause.
+    '''
+
+    actuator_names = topology.actuators
+
+    def __init__(self, timer, sequence, host_arm_map, mid_delay=0.1):
+        self.sequence = sequence
+        self.mid_delay = mid_delay
+        self.logger = logging.getLogger('timer')
+        self.host_names = [topology.address(host) for host in host_arm_map]
+        self.arm_names = [arm for arms in host_arm_map.values() for arm in arms]
+        self.arm_ids = {arm: i for i, arm in enumerate(self.arm_names)}
+        self.actuator_ids = {actuator: i for i, actuator in enumerate(self.actuator_names)}
+        self.arm_hosts = self._index_arm_hosts(host_arm_map)
+
+        # 'H' leaves room for thousands of arms and hosts
+        self.offsets = array('d')
+        self.hosts = array('H')
+        self.arms = array('H')
+        self.actuators = array('B')
+        self.activate = array('B')
+
+        self.step_offsets = array('d')
+        self.step_hosts = array('H')
+        self.step_starts = array('I')
+        self.step_actions = array('H')
+        self.step_orders = array('H')
+        self.messages = []
+
+        self.marks = []
+        self.duration = self._compile(timer)
+        self.logger.info("compiled sequence '{}': {} steps, {} seconds".format(sequence, len(self.messages), self.duration))
+
+    def __len__(self):
+        return len(self.messages)
+
+    def _index_arm_hosts(self, host_arm_map):
+        '''map each arm to the index of the host that controls it'''
+        return {arm: i for i, arms in enumerate(host_arm_map.values()) for arm in arms}
+
+    def _split_mids(self, actuators, activate):
+        '''
+        split an arm's actuator changes into groups, ending a group after every mid
+        valve change. yields (offset, changes) where changes is a list of
+        (actuator, activate) tuples and offset is relative to the arm's first group.
+        '''
+        offset = 0.0
+        group = []
+
+        for actuator, act in zip(actuators, activate):
+            group.append((actuator, act))
+
+            if 'mid' in actuator:
+                yield offset, group
+                offset += self.mid_delay
+                group = []
+
+        if group:
+            yield offset, group
+
+    def _add_step(self, offset, arm, changes, action, order):
+        host = self.arm_hosts[arm]
+        steps = [(arm, actuator, act, 0) for actuator, act in changes]
+
+        self.step_offsets.append(offset)
+        self.step_hosts.append(host)
+        self.step_starts.append(len(self.offsets))
+        self.step_actions.append(action)
+        self.step_orders.append(order)
+        self.messages.append(BatchMessage(steps))
+
+        for _, actuator, act, _ in steps:
+            self.offsets.append(offset)
+            self.hosts.append(host)
+            self.arms.append(self.arm_ids[arm])
+            self.actuators.append(self.actuator_ids[actuator])
+            self.activate.append(int(act))
+
+    def _compile(self, timer):
+        '''
+        each arm fires its action's 'sequence' pause after the previous arm, and the
+        next action starts after the last arm plus the action's 'done' pause. the
+        mid_delay gaps within an arm fall inside those pauses, so they don't
+        stretch the sequence.
+        returns the total duration of the sequence in seconds.
+        '''
+        offset = 0.0
+
+        for a, action in enumerate(timer.sequences[self.sequence]):
+            self.marks.append((offset, 'fire', action))
+            pauses = timer.pauses[action]
+            actuators = timer.actions[action]['actuators']
+            activate = timer.actions[action]['activate']
+
+            for order, arm in enumerate(timer.actions[action]['order']):
+                offset += pauses['sequence'].total_seconds()
+
+                for relative, changes in self._split_mids(actuators, activate):
+                    self._add_step(offset + relative, arm, changes, a, order)
+
+            self.marks.append((max(offset, self.step_offsets[-1]), 'done', action))
+            offset += pauses['done'].total_seconds()
+
+        return offset
+
+    def get_host(self, step):
+        return self.host_names[self.step_hosts[step]]
+
+    def locate(self, step):
+        '''return (action index, arm index) of a step, i.e. where in the sequence it is'''
+        return self.step_actions[step], self.step_orders[step]
+
+    def get_records(self, step):
+        '''return the (arm, actuator, activate) records of a step, mostly for logging'''
+        stop = self.step_starts[step + 1] if step + 1 < len(self.step_starts) else len(self.offsets)
+
+        return [
+            (self.arm_names[self.arms[i]], self.actuator_names[self.actuators[i]], bool(self.activate[i]))
+            for i in range(self.step_starts[step], stop)
+        ]
+
+    def get_host_steps(self, host):
+        '''
+        return the slice of the timeline that runs on the host at index host, as a
+        list of (offset, changes) pairs for an UploadMessage
+        '''
+        return [(self.step_offsets[step], self.get_records(step)) for step in range(len(self)) if self.step_hosts[step] == host]
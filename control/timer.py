@@ -4,8 +4,19 @@
 # updated: 6/18/18
 
 import time
+import heapq
 import logging
-from datetime import datetime, timedelta
+import itertools
+import threading
+from array import array
+from datetime import timedelta
+from timeline import Timeline
+from metrics import registry
+from topology import load_topology
+
+
+topology = load_topology()
+lateness_seconds = registry.histogram('murmur_schedule_lateness_seconds', 'how late the timer handed out each step, per sequence')
 
 
 class Mystic:
@@ -20,8 +31,8 @@ class Mystic:
     8. 3 minute rest in fully closed position
     9. repeat #1 - #8
     '''
-    arms_A_to_M = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'J', 'K', 'L', 'M']
-    arms_M_to_A = ['M', 'L', 'K', 'J', 'H', 'G', 'F', 'E', 'D', 'C', 'B', 'A']
+    arms_A_to_M = topology.orderings['all_arms_cw']
+    arms_M_to_A = topology.orderings['all_arms_ccw']
 
     sequences = {
         'initialize': ['low', 'mid-retract_and_top', 'lowlow'],
@@ -93,12 +104,13 @@ class Anchorage:
     to wait for block removal
     '''
 
-    all_arms_cw = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'J', 'K', 'L', 'M']
-    all_arms_ccw = ['M', 'L', 'K', 'J', 'H', 'G', 'F', 'E', 'D', 'C', 'B', 'A']
-    bottom_arms_cw = ['A', 'C', 'E', 'G', 'J', 'L']
-    bottom_arms_ccw = ['L', 'J', 'G', 'E', 'C', 'A']
-    top_arms_cw = ['B', 'D', 'H', 'K', 'F', 'M']  # NOTE: weird order so arms don't conflict
-    top_arms_ccw = ['M', 'K', 'F', 'H', 'D', 'B']  # NOTE: this is a hack to get F out of the way of H on the mid movement
+    # orderings are generated from the geometry in topology.yaml
+    all_arms_cw = topology.orderings['all_arms_cw']
+    all_arms_ccw = topology.orderings['all_arms_ccw']
+    bottom_arms_cw = topology.orderings['bottom_arms_cw']
+    bottom_arms_ccw = topology.orderings['bottom_arms_ccw']
+    top_arms_cw = topology.orderings['top_arms_cw']  # NOTE: weird order so arms don't conflict, set in topology.yaml
+    top_arms_ccw = topology.orderings['top_arms_ccw']  # NOTE: this is a hack to get F out of the way of H on the mid movement
 
     sequences = {
         'start': ['top_restore'],
@@ -187,17 +199,184 @@ class Anchorage:
     }
 
 
+class Clock:
+    '''
+    the time the Timer runs on. monotonic() is for deadlines, time() is the wall
+    clock start datetimes are given on, and wait() blocks on an event for up to
+    seconds of this clock's time, returning True if the event was set.
+    this one is real time, see ScaledClock and VirtualClock for rehearsals.
+    '''
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def time(self):
+        return time.time()
+
+    def wait(self, event, seconds):
+        return event.wait(seconds)
+
+    def from_real(self, seconds):
+        '''how much of this clock's time passes in seconds of real time'''
+        return seconds
+
+
+class ScaledClock(Clock):
+    '''
+    a clock that runs speed times faster than real time from when it's created,
+    so every pause, including the mid valve gaps, is divided by speed. the nodes
+    still hold a mid valve change for its real gap, so at high speeds the steps
+    after one can come out late.
+    '''
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.monotonic_origin = time.monotonic()
+        self.time_origin = time.time()
+
+    def monotonic(self):
+        return self.monotonic_origin + (time.monotonic() - self.monotonic_origin) * self.speed
+
+    def time(self):
+        return self.time_origin + (time.time() - self.time_origin) * self.speed
+
+    def wait(self, event, seconds):
+        return event.wait(seconds / self.speed)
+
+    def from_real(self, seconds):
+        return seconds * self.speed
+
+
+class VirtualClock(Clock):
+    '''
+    a clock that only moves when it's waited on, and then jumps straight to the
+    end of the wait, so sequences run as fast as the nodes take the commands.
+    it starts at the real time, and a wait on an event that's already set
+    returns right away without moving the clock.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.monotonic_now = time.monotonic()
+        self.time_origin = time.time() - self.monotonic_now
+
+    def monotonic(self):
+        with self.lock:
+            return self.monotonic_now
+
+    def time(self):
+        return self.time_origin + self.monotonic()
+
+    def wait(self, event, seconds):
+        if event.is_set():
+            return True
+
+        with self.lock:
+            self.monotonic_now += max(0.0, seconds)
+
+        return False
+
+    def from_real(self, seconds):
+        # only waiting moves this clock
+        return 0.0
+
+
+class Scheduler:
+    '''
+    priority queue of timestamped events. wait() sleeps until the earliest
+    deadline in the queue, or until the interrupt event is set by someone else
+    (the watchdog sets it when the state file changes), whichever comes first.
+
+    deadlines are clock.monotonic() seconds, so they don't move when NTP steps
+    the wall clock. events are handed out as (lateness, event) tuples, where
+    lateness is how many seconds after its deadline the event was popped.
+    '''
+
+    def __init__(self, interrupt=None, clock=None):
+        self.queue = []
+        self.counter = itertools.count()  # tie breaker so events with equal deadlines keep insertion order
+        self.interrupt = interrupt if interrupt else threading.Event()
+        self.clock = clock if clock else Clock()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def push(self, deadline, event):
+        heapq.heappush(self.queue, (deadline, next(self.counter), event))
+
+    def shift(self, delta):
+        '''push every pending deadline back by delta, for instance after a pause'''
+        self.queue = [(deadline + delta, count, event) for deadline, count, event in self.queue]
+
+    def clear(self):
+        self.queue = []
+
+    def pop_ready(self):
+        '''pop and return every event whose deadline has already passed'''
+        now = self.clock.monotonic()
+        ready = []
+
+        while self.queue and self.queue[0][0] <= now:
+            deadline, _, event = heapq.heappop(self.queue)
+            ready.append((now - deadline, event))
+
+        return ready
+
+    def wait(self):
+        '''
+        pop and return the next event once its deadline is reached. if the interrupt
+        is set first we return None without popping anything. the interrupt is
+        not cleared here, that's left to whoever handles the state change.
+        '''
+        deadline = self.queue[0][0]
+
+        while True:
+            remaining = deadline - self.clock.monotonic()
+
+            if remaining <= 0:
+                return -remaining, heapq.heappop(self.queue)[-1]
+            elif self.clock.wait(self.interrupt, remaining):
+                return None
+
+
 class Timer:
     '''
-    machinery to (somewhat) asynchronously run the sequences specified by
-    the timer class passed into __init__()
+    machinery to asynchronously run the sequences specified by the timer class
+    passed into __init__(). every sequence is compiled into a Timeline up front,
+    and when a sequence starts its steps and pauses are laid out in a Scheduler
+    against the sequence's start time. run() then sleeps until each deadline
+    instead of polling the clock.
+
+    every deadline is an absolute offset from the start on clock.monotonic(), so
+    time spent sending, logging or waiting on the nodes never accumulates into
+    drift. if we fall behind, everything that's due goes out together right away
+    and the rest of the schedule stays where it was. steps handed out more than
+    late_warning seconds after their deadline are logged, and the lateness of
+    every step in a run is summarized in self.lateness[sequence] when it ends.
+
+    self.position is the (timeline, step index) of the last step handed out, which
+    main.py checkpoints so a restarted control can resume a sequence part way.
+
+    clock defaults to real time. a ScaledClock or VirtualClock runs the same
+    schedule faster, with the events in the same order, e.g. to rehearse a whole
+    show against the nodes in minutes.
     '''
 
-    def __init__(self, timer=None):
+    mid_delay = 0.1  # seconds between steps after a mid valve changes state, keep above the nodes' Node.mid_separation
+    late_warning = 0.05  # seconds
+
+    def __init__(self, timer=None, host_arm_map=None, interrupt=None, clock=None):
+        '''interrupt is a threading.Event that is set when there's a state change to check'''
         self.logger = self._initialize_logger()
         self.pauses = timer.pauses
         self.actions = timer.actions
         self.sequences = timer.sequences
+        self.hosts = [topology.address(host) for host in host_arm_map]
+        self.timelines = self._compile_timelines(timer, host_arm_map)
+        self.clock = clock if clock else Clock()
+        self.scheduler = Scheduler(interrupt=interrupt, clock=self.clock)
+        self.lateness = {}  # sequence -> lateness summary of its last run, see _summarize()
+        self.position = None
 
     def _initialize_logger(self):
         logger = logging.getLogger('timer')
@@ -205,54 +384,146 @@ class Timer:
 
         return logger
 
-    def _get_pause(self, pause):
-        return datetime.now() + pause
+    def _compile_timelines(self, timer, host_arm_map):
+        return {sequence: Timeline(timer, sequence, host_arm_map, mid_delay=self.mid_delay) for sequence in self.sequences}
 
-    def _pause(self, action):
-        paws = self.pauses[action]['done']
-        self.logger.info('done firing {action}, pausing for {pause} seconds...'.format(action=action, pause=paws.seconds))
-        pause = self._get_pause(paws)
+    def _get_elapsed(self, timeline, resume, late):
+        '''
+        how far into the sequence to pick up after the step at offset resume was
+        sent late seconds ago. the time is taken out of the pause that follows it,
+        but the next step is never skipped, it's sent straight away instead.
+        '''
+        following = [offset for offset in timeline.step_offsets if offset > resume]
 
-        while True:
-            if datetime.now() <= pause:
-                yield None
-            else:
-                yield None
-                break
+        return min(resume + late, min(following) if following else timeline.duration)
 
-    def _fire(self, action):
+    def _schedule(self, timeline, start=None, resume=None, late=0.0):
         '''
-        we yield None if pause (a datetime.timedelta object) is in the future,
-        otherwise we yield an action. we have to yield None to give the watchdog
-        a chance to concurrently check for state changes while a sequence is running.
-        also if the actuator is a 'mid' we pause 1/10th a second to ensure both
-        mid-valves are never fired at the same time.
+        queue up every step and mark of a compiled timeline against start, a
+        datetime on clock.time() that defaults to now. start is converted to
+        clock.monotonic() once, and every deadline is an offset from it.
+        when resuming, the steps and marks at or before the offset resume are
+        left out, and the sequence is shifted so we're _get_elapsed() into it.
+        events are tuples formatted (kind, index), where index points into either
+        timeline.messages (kind 'step') or timeline.marks (kind 'mark').
         '''
-        self.logger.info('firing {}'.format(action))
+        origin = self.clock.monotonic()
 
-        for arm in self.actions[action]['order']:
-            pause = self._get_pause(self.pauses[action]['sequence'])
+        if start:
+            origin += start.timestamp() - self.clock.time()
 
-            while True:
-                if datetime.now() <= pause:
-                    yield None
+        if resume is None:
+            resume = -1.0
+        else:
+            origin -= self._get_elapsed(timeline, resume, late)
+
+        for i, offset in enumerate(timeline.step_offsets):
+            if offset > resume:
+                self.scheduler.push(origin + offset, ('step', i))
+
+        for i, (offset, kind, action) in enumerate(timeline.marks):
+            if offset > resume:
+                self.scheduler.push(origin + offset, ('mark', i))
+
+        self.scheduler.push(origin + timeline.duration, ('end', None))
+
+    def duration(self, sequence):
+        '''total length of a sequence in seconds, including its final pause'''
+        return self.timelines[sequence].duration
+
+    def _get_commands(self, timeline, events, samples):
+        '''
+        log any marks and return a list of (host, BatchMessage) commands for the step
+        events. the lateness of each step is added to samples.
+        '''
+        commands = []
+
+        for late, (kind, index) in events:
+            if kind == 'step':
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('yielding steps: %s', timeline.get_records(index))
+
+                commands.append((timeline.get_host(index), timeline.messages[index]))
+                self.position = (timeline, index)
+                samples.append(late)
+                lateness_seconds.observe(late, sequence=timeline.sequence)
+
+                if late > self.late_warning:
+                    self.logger.warning("step {} of '{}' is {:.3f} seconds late, catching up".format(index, timeline.sequence, late))
+            elif kind == 'mark':
+                offset, mark, action = timeline.marks[index]
+
+                if mark == 'fire':
+                    self.logger.info('firing {}'.format(action))
                 else:
-                    actuators = self.actions[action]['actuators']
-                    activate = self.actions[action]['activate']
+                    paws = self.pauses[action]['done']
+                    self.logger.info('done firing {action}, pausing for {pause} seconds...'.format(action=action, pause=paws.seconds))
 
-                    for i in range(len(actuators)):
-                        action_tuple = (arm, actuators[i], activate[i])
-                        self.logger.debug('yielding action: {}'.format(action_tuple))
-                        yield (action_tuple)
+        return commands
 
-                        # slight pause to ensure both mid valves are never open simultaneously
-                        if 'mid' in actuators[i]:
-                            time.sleep(0.1)
-                    break
+    def _summarize(self, sequence, samples):
+        '''store and log the mean, 99th percentile and max lateness of a run, in seconds'''
+        if not samples:
+            return
 
-    def run(self, sequence):
-        seq = self.sequences[sequence]
+        ordered = sorted(samples)
+        summary = {
+            'steps': len(ordered),
+            'mean': sum(ordered) / len(ordered),
+            'p99': ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))],
+            'max': ordered[-1],
+            'late': sum(1 for late in ordered if late > self.late_warning)
+        }
+        self.lateness[sequence] = summary
+        self.logger.info("'{sequence}' lateness over {steps} steps: mean {mean:.4f}s, p99 {p99:.4f}s, max {max:.4f}s, {late} late".format(sequence=sequence, **summary))
 
-        for thing in seq:
-            yield from self._fire(thing)
-            yield from self._pause(thing)
+    def run(self, sequence, start=None, resume=None, late=0.0):
+        '''
+        when a deadline comes up we yield a list of (host, BatchMessage) commands for
+        every step that is due, where the BatchMessage was encoded up front.
+        main.py sends them with Sender.send_many(), so steps that are due at the same
+        time on different hosts go out in parallel. if a state change interrupts the
+        wait we yield None to give the watchdog a chance to handle it. any time spent
+        outside the generator after that (e.g. while the watchdog is paused) pushes
+        the rest of the sequence back by the same amount. the lateness summary is
+        stored when the run ends, including when it's broken out of.
+
+        resume is the offset of the last step sent before a restart, and late is
+        how many seconds ago it was sent, in this timer's clock time (see
+        Clock.from_real()). the run then carries on from the step after it, see
+        _schedule().
+        '''
+        timeline = self.timelines[sequence]
+        samples = array('d')
+        self.position = None
+        self.scheduler.clear()
+        self._schedule(timeline, start=start, resume=resume, late=late)
+
+        if resume is not None:
+            self.logger.info("resuming '{}' after {:.1f} seconds".format(sequence, resume))
+
+        try:
+            while self.scheduler:
+                event = self.scheduler.wait()
+
+                if event is None:
+                    suspended = self.clock.monotonic()
+                    yield None
+                    self.scheduler.shift(self.clock.monotonic() - suspended)
+                    continue
+
+                commands = self._get_commands(timeline, [event] + self.scheduler.pop_ready(), samples)
+
+                if commands:
+                    yield commands
+        finally:
+            self._summarize(sequence, samples)
+
+    def follow(self, sequence, start=None):
+        '''
+        keep time with a sequence that the nodes are running themselves. this goes
+        through the same schedule as run(), but only yields None on state changes.
+        '''
+        for commands in self.run(sequence, start=start):
+            if commands is None:
+                yield None
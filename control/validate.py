@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# murmur - validate and simulate sequences offline
+# 10/18/26
+
+'''
+expands sequences from a timer class in timer.py, such as Anchorage or Mystic,
+into the state of every actuator on every arm over time, without any nodes and
+without waiting for the pauses, e.g.:
+
+    python3 control/validate.py Anchorage initialize main_loop --loops 10
+
+the sequences run back to back, every arm starts with everything off, and each
+'main_loop' is repeated 'loops' times like main.py would. the sequences are
+compiled into Timelines, and the states are a numpy array of change times x arms
+x actuators, so every invariant is checked against the whole run at once:
+
+    mids        mid-ext and mid-retract are never open together on an arm
+    top         top never fires while the arm's low is activated
+
+it then reports the total duration, each actuator's duty cycle (the fraction of
+the time it's open, the mean over arms with the lowest and highest arm) and the
+peak number of valves open at once. the exit status is 1 if an invariant is
+broken, so it can be run before deploying a change to the sequences.
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+# for topology.py, at the top of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import timer as timers
+from timeline import Timeline
+from topology import load_topology
+
+
+# pairs of actuators that must never be open on the same arm at the same time
+invariants = {
+    'mids': ('mid-ext', 'mid-retract'),
+    'top': ('top', 'low')
+}
+
+
+def compile_timelines(timer, sequences):
+    '''compile each distinct sequence once, returns {sequence: Timeline}'''
+    host_arm_map = load_topology().host_arm_map
+
+    return {sequence: Timeline(timer, sequence, host_arm_map) for sequence in set(sequences)}
+
+
+def get_columns(timelines, sequences):
+    '''
+    the records of sequences run back to back, as numpy arrays of times, channels
+    and activate, where a channel is arm id * number of actuators + actuator id.
+    returns those plus the total duration in seconds.
+    '''
+    width = len(Timeline.actuator_names)
+    columns = {}
+
+    for sequence, timeline in timelines.items():
+        columns[sequence] = (
+            np.asarray(timeline.offsets),
+            np.asarray(timeline.arms).astype(np.intp) * width + np.asarray(timeline.actuators),
+            np.asarray(timeline.activate).astype(np.int8)
+        )
+
+    times, channels, activate = [], [], []
+    start = 0.0
+
+    for sequence in sequences:
+        offsets, chans, acts = columns[sequence]
+        times.append(offsets + start)
+        channels.append(chans)
+        activate.append(acts)
+        start += timelines[sequence].duration
+
+    return np.concatenate(times), np.concatenate(channels), np.concatenate(activate), start
+
+
+def simulate(times, channels, activate, n):
+    '''
+    replay the records on n channels, all starting off. returns (change times,
+    states), where states[i] holds every channel's state from change times[i]
+    until the next change. records at the same time are applied in order and
+    only the last one for a channel counts, like a node applying a step.
+    the first row is the starting state at time 0.
+    '''
+    order = np.argsort(times, kind='stable')
+    times, channels, activate = times[order], channels[order], activate[order]
+    change_times, rows = np.unique(times, return_inverse=True)
+
+    # keep the last record for every (row, channel)
+    keys = rows * n + channels
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+
+    changes = np.full((len(change_times), n), -1, dtype=np.int8)
+    changes[rows[last], channels[last]] = activate[last]
+
+    # carry every change forward to the rows after it, until the channel changes again
+    filled = np.where(changes >= 0, np.arange(len(change_times))[:, None], -1)
+    np.maximum.accumulate(filled, axis=0, out=filled)
+    states = np.where(filled >= 0, changes[filled, np.arange(n)], 0)
+
+    return np.concatenate(([0.0], change_times)), np.vstack((np.zeros((1, n), dtype=states.dtype), states)).astype(bool)
+
+
+def check(times, states, duration, arm_names):
+    '''
+    returns {invariant: violations}, where violations is a list of (time, arm,
+    seconds) for every stretch of time the invariant is broken on an arm, in order
+    '''
+    names = Timeline.actuator_names
+    ends = np.append(times, duration)
+    violations = {}
+
+    for invariant, (first, second) in invariants.items():
+        broken = states[:, :, names.index(first)] & states[:, :, names.index(second)]
+
+        # +1 where a stretch starts on an arm and -1 at the row after it ends
+        edges = np.diff(np.pad(broken.astype(np.int8), ((1, 1), (0, 0))), axis=0)
+        start_arms, start_rows = np.nonzero((edges == 1).T)
+        _, end_rows = np.nonzero((edges == -1).T)
+        seconds = ends[end_rows] - times[start_rows]
+        found = sorted((times[row], arm_names[arm], length) for row, arm, length in zip(start_rows.tolist(), start_arms.tolist(), seconds.tolist()) if length > 0)
+        violations[invariant] = found
+
+    return violations
+
+
+def validate(timer, sequences):
+    timelines = compile_timelines(timer, sequences)
+    arm_names = next(iter(timelines.values())).arm_names
+    width = len(Timeline.actuator_names)
+
+    started = time.perf_counter()
+    times, channels, activate, duration = get_columns(timelines, sequences)
+    change_times, states = simulate(times, channels, activate, len(arm_names) * width)
+    states = states.reshape(len(change_times), len(arm_names), width)
+    durations = np.diff(np.append(change_times, duration))
+
+    duty = (states * durations[:, None, None]).sum(axis=0) / duration if duration else np.zeros((len(arm_names), width))
+    opened = states.sum(axis=(1, 2))
+    opened[durations == 0] = 0
+    peak = int(opened.argmax())
+    violations = check(change_times, states, duration, arm_names)
+    elapsed = time.perf_counter() - started
+
+    return {
+        'sequences': sequences,
+        'records': len(times),
+        'changes': len(change_times) - 1,
+        'seconds': duration,
+        'duty_cycle': {
+            actuator: {
+                'mean': float(duty[:, i].mean()),
+                'min': (arm_names[int(duty[:, i].argmin())], float(duty[:, i].min())),
+                'max': (arm_names[int(duty[:, i].argmax())], float(duty[:, i].max()))
+            }
+            for i, actuator in enumerate(Timeline.actuator_names)
+        },
+        'peak_open': (int(opened[peak]), float(change_times[peak])),
+        'violations': violations,
+        'elapsed': elapsed
+    }
+
+
+def format_seconds(seconds):
+    return '{:d}:{:02d}:{:06.3f}'.format(int(seconds // 3600), int(seconds % 3600 // 60), seconds % 60)
+
+
+def report(results, limit=10):
+    lines = [
+        '{} records, {} state changes, {} total'.format(results['records'], results['changes'], format_seconds(results['seconds'])),
+        'peak: {} valves open at {}'.format(results['peak_open'][0], format_seconds(results['peak_open'][1])),
+        'duty cycle:'
+    ]
+
+    for actuator, duty in results['duty_cycle'].items():
+        lines.append('  {:<12} mean {:6.1%}  min {:6.1%} ({})  max {:6.1%} ({})'.format(actuator, duty['mean'], duty['min'][1], duty['min'][0], duty['max'][1], duty['max'][0]))
+
+    for invariant, violations in results['violations'].items():
+        if not violations:
+            lines.append("invariant '{}': ok".format(invariant))
+            continue
+
+        lines.append("invariant '{}': broken {} times for {:.3f} seconds in all".format(invariant, len(violations), sum(seconds for _, _, seconds in violations)))
+
+        for at, arm, seconds in violations[:limit]:
+            lines.append('  {} arm {} for {:.3f} seconds'.format(format_seconds(at), arm, seconds))
+
+        if len(violations) > limit:
+            lines.append('  ... and {} more'.format(len(violations) - limit))
+
+    lines.append('validated in {:.1f} ms'.format(results['elapsed'] * 1000))
+
+    return '\n'.join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='validate murmur sequences offline')
+    parser.add_argument('timer', nargs='?', default='Anchorage', help='timer class in timer.py, e.g. Anchorage or Mystic')
+    parser.add_argument('sequences', nargs='*', default=['initialize', 'main_loop'], help='sequences to run back to back')
+    parser.add_argument('--loops', type=int, default=1, help="how many times to run each 'main_loop'")
+    parser.add_argument('--limit', type=int, default=10, help='violations to list for each invariant')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    timer = getattr(timers, args.timer, None)
+
+    if not isinstance(timer, type) or not hasattr(timer, 'sequences'):
+        sys.exit("no timer class '{}' in timer.py".format(args.timer))
+
+    unknown = [sequence for sequence in args.sequences if sequence not in timer.sequences]
+
+    if unknown:
+        sys.exit('{} has no sequences {}, expected some of {}'.format(args.timer, unknown, ', '.join(timer.sequences)))
+
+    sequences = [run for sequence in args.sequences for run in [sequence] * (args.loops if sequence == 'main_loop' else 1)]
+    results = validate(timer, sequences)
+    print(report(results, limit=args.limit))
+
+    sys.exit(1 if any(results['violations'].values()) else 0)
@@ -6,6 +6,7 @@
 import os
 import time
 import logging
+import threading
 
 
 def get_basepath():
@@ -16,8 +17,15 @@ class Watchdog:
     '''
     state_file is the file updated by buttons.py when touchscreen buttons are pressed.
     state_map translates states to sequence lists for run and run_sequence in main.py
+
+    once start() is called a background thread stats state_file every poll_interval
+    seconds and sets the 'changed' event when it's been modified. check_state() only
+    reads the file when that event is set, and anyone waiting on 'changed' (the
+    Timer's scheduler, or wait() below) is woken up immediately.
     '''
 
+    poll_interval = 0.1
+
     state_file = os.path.join(get_basepath(), 'state.txt')
 
     state_map = {
@@ -29,6 +37,9 @@ class Watchdog:
 
     def __init__(self):
         self.logger = self._initialize_logger()
+        self.changed = threading.Event()
+        self.watching = False
+        self.callbacks = {}
         self.state = self._read_state_file()
         self.logger.info('watchdog initialized with state {}'.format(self.state.upper()))
 
@@ -42,6 +53,24 @@ class Watchdog:
         with open(self.state_file, 'r') as fyle:
             return fyle.read().strip(' \n')
 
+    def _stat_state_file(self):
+        try:
+            stat = os.stat(self.state_file)
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _watch(self):
+        last = self._stat_state_file()
+
+        while True:
+            time.sleep(self.poll_interval)
+            current = self._stat_state_file()
+
+            if current != last:
+                last = current
+                self.changed.set()
+
     def _register_state_change(self, current):
         self.logger.info('state change registered from {} to {}'.format(self.state.upper(), current.upper()))
         self.state = current
@@ -54,12 +83,15 @@ class Watchdog:
             if self.check_state():
                 break
             else:
-                time.sleep(0.1)
+                self.wait()
 
     def _handle_state_change(self, current):
         '''this method is used to pause the program if 'pause' state is registered'''
         self._register_state_change(current)
 
+        if self.state in self.callbacks:
+            self.callbacks[self.state]()
+
         if self.state == 'pause':
             self._pause()
         elif self.state == 'resume':
@@ -67,12 +99,42 @@ class Watchdog:
         else:
             pass
 
+    def add_callback(self, state, callback):
+        '''
+        call callback() whenever a change to state is registered, before the state
+        is handled. main.py uses this to pass 'pause' and 'resume' on to the nodes.
+        '''
+        self.callbacks[state] = callback
+
+    def start(self):
+        '''start the background thread that watches state_file for changes'''
+        self.logger.info('watching {} for changes'.format(self.state_file))
+        self.watching = True
+        threading.Thread(target=self._watch, name='watchdog', daemon=True).start()
+
+    def wait(self, timeout=None):
+        '''
+        block until state_file changes or timeout seconds pass. if the watcher
+        thread isn't running we just sleep for poll_interval seconds.
+        '''
+        if not self.watching:
+            time.sleep(self.poll_interval)
+            return True
+
+        return self.changed.wait(timeout)
+
     def check_state(self):
         '''
         if there is a state change, return the state, otherwise return None.
         _pause() method in particular uses this to break out of sleep loop if
         something other than None is returned.
         '''
+        if self.watching:
+            if not self.changed.is_set():
+                return None
+
+            self.changed.clear()
+
         current = self._read_state_file()
 
         if current and current != self.state:
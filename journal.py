@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+# murmur - append-only binary journal of every actuator change
+# 10/18/26
+
+'''
+every actuator change that's sent (control) or applied (nodes) is appended to a
+journal file as a fixed size binary record, so the history can be kept for weeks
+and read back without parsing any text:
+
+    python3 journal.py nodes/journal/murmur01-20261018-190000.journal
+
+each process writes its own file, named after the host and when it started, in
+its journal directory (control/journal or nodes/journal). a file starts with a
+header the size of one record:
+
+    magic, version, record size, time.time() and time.monotonic() when it was opened
+
+and then one record for every actuator change:
+
+    time.monotonic(), sequence id, arm id, actuator id, activate, status, latency
+
+the sequence id is the frame's sequence number when it went out as a binary frame,
+or the multicast sequence number of a fleet message, so the records on control
+and on the nodes can be matched up. it's 0 for json messages. arm and actuator
+ids are positions in topology.yaml, statuses are listed in 'statuses' and
+latency is in seconds, from sending to the ack on control and from receiving to
+applying on the nodes.
+'''
+
+import os
+import sys
+import mmap
+import time
+import atexit
+import struct
+import threading
+from collections import namedtuple
+from datetime import datetime
+from topology import load_topology
+
+
+MAGIC = b'MJNL'
+VERSION = 1
+HEADER = struct.Struct('<4sHHdd')
+RECORD = struct.Struct('<dIHBBB3xf')
+
+# a status's code in a record is its position here. these aren't the nodes' ack
+# status codes in protocol.py, statuses are recorded by name and mapped here, so
+# new ones go at the end to keep older journals readable
+statuses = ['applied', 'rejected', 'unknown actuator', 'malformed', 'received', 'broadcast', 'unacked', 'scheduled']
+status_codes = {status: i for i, status in enumerate(statuses)}
+
+Entry = namedtuple('Entry', ['time', 'seq', 'arm', 'actuator', 'activate', 'status', 'latency'])
+
+
+class Journal(object):
+    '''
+    appends records to a new file in directory, named after name and the time
+    it's opened. records are buffered and flushed every flush_interval seconds by
+    a background thread, so writing one costs about as much as packing it.
+    journal files more than keep_days old are removed when a new one is opened.
+    '''
+
+    def __init__(self, directory, name, keep_days=28, flush_interval=1.0):
+        self.topology = load_topology()
+        self.arm_ids = self.topology.arm_ids
+        self.actuator_ids = {actuator: i for i, actuator in enumerate(self.topology.actuators)}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.flush_interval = flush_interval
+
+        os.makedirs(directory, exist_ok=True)
+        self._prune(directory, keep_days)
+        self.path = os.path.join(directory, '{}-{}.journal'.format(name, datetime.now().strftime('%Y%m%d-%H%M%S')))
+        self.file = open(self.path, 'ab')
+        self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, time.time(), time.monotonic()))
+
+        threading.Thread(target=self._flush_periodically, name='journal', daemon=True).start()
+        atexit.register(self.close)
+
+    def _prune(self, directory, keep_days):
+        cutoff = time.time() - keep_days * 86400
+
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+
+            if filename.endswith('.journal') and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def record(self, steps, status, seq=0, latency=0.0):
+        '''
+        append a record for every (arm, actuator, activate, ...) step. status is one
+        of 'statuses', by name.
+        '''
+        code = status_codes[status]
+        now = time.monotonic()
+        records = b''.join(
+            RECORD.pack(now, seq, self.arm_ids.get(arm, 0xFFFF), self.actuator_ids.get(actuator, 0xFF), 1 if activate else 0, code, latency)
+            for arm, actuator, activate, *_ in steps
+        )
+
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(records)
+
+    def flush(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+
+    def close(self):
+        self.stopped.set()
+
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+class JournalReader(object):
+    '''
+    maps a journal file into memory, records are unpacked straight from the map
+    when they're read. a record that was only partly written is ignored.
+
+        reader = JournalReader(path)
+        for entry in reader:
+            print(reader.wall_time(entry.time), entry.arm, entry.actuator, entry.status)
+    '''
+
+    def __init__(self, path, topology=None):
+        self.topology = topology if topology else load_topology()
+
+        with open(path, 'rb') as journal:
+            self.map = mmap.mmap(journal.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, size, self.wall, self.monotonic = HEADER.unpack_from(self.map)
+
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            self.map.close()
+            raise ValueError('{} is not a version {} journal'.format(path, VERSION))
+
+    def __len__(self):
+        return (len(self.map) - HEADER.size) // RECORD.size
+
+    def _entry(self, fields):
+        t, seq, arm, actuator, activate, status, latency = fields
+
+        return Entry(
+            t,
+            seq,
+            self.topology.arms[arm] if arm < len(self.topology.arms) else None,
+            self.topology.actuators[actuator] if actuator < len(self.topology.actuators) else None,
+            bool(activate),
+            statuses[status] if status < len(statuses) else None,
+            latency
+        )
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError('journal record {} out of range'.format(i))
+
+        return self._entry(RECORD.unpack_from(self.map, HEADER.size + i * RECORD.size))
+
+    def __iter__(self):
+        records = memoryview(self.map)[HEADER.size:HEADER.size + len(self) * RECORD.size]
+
+        try:
+            for fields in RECORD.iter_unpack(records):
+                yield self._entry(fields)
+        finally:
+            records.release()
+
+    def wall_time(self, t):
+        '''convert a record's time.monotonic() to a time.time() timestamp'''
+        return self.wall + t - self.monotonic
+
+    def close(self):
+        self.map.close()
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        reader = JournalReader(path)
+
+        for entry in reader:
+            print('{}  seq {:<6} {} {:<12} {:<6} {:<16} {:.4f}s'.format(
+                datetime.fromtimestamp(reader.wall_time(entry.time)).isoformat(timespec='milliseconds'),
+                entry.seq, entry.arm, entry.actuator, 'on' if entry.activate else 'off', entry.status, entry.latency))
+
+        reader.close()
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# murmur - queue the log records of the hot paths and write them in batches
+# 10/18/26
+
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+from collections import OrderedDict
+
+
+class Lazy(object):
+    '''
+    a log argument that's only worked out if the record is formatted, e.g.
+    logger.info('sent %s', Lazy(msg.decode)) doesn't decode msg for a dropped record
+    '''
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class RateLimit(logging.Filter):
+    '''
+    lets through at most 'rate' records a second, with bursts of up to 'burst',
+    of every message at or below 'level' from every logger. messages are told
+    apart by their format string, so lines logged with %s arguments count as
+    one message however the arguments change. the first record let through after
+    some were dropped says how many. warnings and errors are never dropped.
+    a record gets the same answer from every handler the filter is on.
+    set up in log.yaml, see install_queue().
+
+    most lines are formatted before they're logged, so nearly every one is a
+    message of its own. at most max_buckets messages are tracked, the least
+    recently seen is forgotten to make room for a new one. a forgotten message
+    starts over with a full burst, and any count of its dropped records is lost.
+    '''
+
+    def __init__(self, rate=10.0, burst=20, level='INFO', max_buckets=1024):
+        super().__init__()
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.level = level if isinstance(level, int) else logging.getLevelName(level)
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # (logger name, format string) -> [tokens, last refill, dropped], least recent first
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+
+        if hasattr(record, 'rate_limited'):
+            return not record.rate_limited
+
+        key = (record.name, record.msg)
+        now = time.monotonic()
+
+        with self.lock:
+            bucket = self.buckets.get(key)
+
+            if bucket is None:
+                if len(self.buckets) >= self.max_buckets:
+                    self.buckets.popitem(last=False)
+
+                bucket = self.buckets[key] = [self.burst, now, 0]
+            else:
+                self.buckets.move_to_end(key)
+
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+            record.rate_limited = bucket[0] < 1.0
+
+            if record.rate_limited:
+                bucket[2] += 1
+                return False
+
+            bucket[0] -= 1.0
+            dropped, bucket[2] = bucket[2], 0
+
+        if dropped:
+            record.msg = '{} [{} more like this dropped]'.format(record.msg, dropped)
+
+        return True
+
+
+class BatchedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    '''
+    RotatingFileHandler that leaves the writes in the file's buffer until the
+    listener calls flush_batch(), and only checks whether to roll over then,
+    instead of seeking and formatting every record twice
+    '''
+
+    def shouldRollover(self, record):
+        return False
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        self.acquire()
+
+        try:
+            if self.stream is None:
+                return
+
+            self.stream.flush()
+
+            if self.maxBytes > 0 and self.stream.tell() >= self.maxBytes:
+                self.doRollover()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush_batch()
+        super().close()
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    '''
+    stands in for handler on the logging threads. records go on the queue as they
+    are, the formatting is left to the listener thread.
+    '''
+
+    def __init__(self, queue, handler):
+        super().__init__(queue)
+        self.handler = handler
+        self.setLevel(handler.level)
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        self.queue.put_nowait((self.handler, record))
+
+
+class Listener(object):
+    '''
+    one background thread that hands queued records to their real handlers, up to
+    'batch' at a time, and flushes each handler once per batch
+    '''
+
+    def __init__(self, queue, batch=256):
+        self.queue = queue
+        self.batch = batch
+        self.thread = None
+
+    def _handle(self, items):
+        handlers = set()
+
+        for handler, record in items:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+                handlers.add(handler)
+
+        for handler in handlers:
+            getattr(handler, 'flush_batch', handler.flush)()
+
+    def _monitor(self):
+        while True:
+            items = [self.queue.get()]
+
+            while len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in items
+            self._handle([item for item in items if item is not None])
+
+            if stop:
+                return
+
+    def start(self):
+        self.thread = threading.Thread(target=self._monitor, name='logging', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''write out everything that's queued and stop the thread'''
+        if self.thread is not None:
+            self.queue.put_nowait(None)
+            self.thread.join()
+            self.thread = None
+
+
+def install_queue(log_config, batch=256):
+    '''
+    call after logging.config.dictConfig(log_config). every handler of the root
+    logger and of the loggers in log_config is swapped for a QueueHandler, and a
+    Listener thread passes the records on to the real handlers. any filters on a
+    handler, like RateLimit, move to its QueueHandler so dropped records are never
+    queued. the listener is stopped at exit so nothing queued is lost.
+    returns the Listener.
+    '''
+    records = queue.Queue()
+    listener = Listener(records, batch=batch)
+    replaced = {}
+
+    for name in [''] + list(log_config.get('loggers', {})):
+        logger = logging.getLogger(name)
+
+        for handler in list(logger.handlers):
+            if handler not in replaced:
+                replaced[handler] = QueueHandler(records, handler)
+                replaced[handler].filters = handler.filters
+                handler.filters = []
+
+            logger.removeHandler(handler)
+            logger.addHandler(replaced[handler])
+
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
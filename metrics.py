@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+# murmur - latency histograms with a prometheus text endpoint
+# 10/18/26
+
+import os
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+# upper bounds in seconds, shared by every histogram so they're easy to compare.
+# they cover everything from a GPIO write up to a stalled wifi link.
+buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram(object):
+    '''counts of observations in fixed buckets, plus their sum and total count'''
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class HistogramFamily(object):
+    '''
+    histograms of one metric, one for each combination of label values. observe()
+    is cheap enough to call on the send and apply paths: a lock, a dict lookup and
+    a binary search over the buckets.
+    '''
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.histograms = {}  # tuple of sorted (label, value) pairs -> Histogram
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            histogram = self.histograms.get(key)
+
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+
+            histogram.observe(value)
+
+    def _format_labels(self, key, le=None):
+        pairs = list(key) + ([('le', le)] if le is not None else [])
+
+        if not pairs:
+            return ''
+
+        return '{{{}}}'.format(','.join('{}="{}"'.format(label, value) for label, value in pairs))
+
+    def render(self):
+        '''return the family in the prometheus text exposition format'''
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+
+        with self.lock:
+            histograms = [(key, list(h.counts), h.sum, h.count) for key, h in sorted(self.histograms.items())]
+
+        for key, counts, total, count in histograms:
+            cumulative = 0
+
+            for bound, n in zip([repr(b) for b in buckets] + ['+Inf'], counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(self.name, self._format_labels(key, le=bound), cumulative))
+
+            lines.append('{}_sum{} {!r}'.format(self.name, self._format_labels(key), total))
+            lines.append('{}_count{} {}'.format(self.name, self._format_labels(key), count))
+
+        return '\n'.join(lines)
+
+
+class Registry(object):
+    '''every histogram family in the process, modules get theirs with histogram()'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+
+    def histogram(self, name, help):
+        with self.lock:
+            if name not in self.families:
+                self.families[name] = HistogramFamily(name, help)
+
+            return self.families[name]
+
+    def render(self):
+        with self.lock:
+            families = list(self.families.values())
+
+        return '\n'.join(family.render() for family in families) + '\n'
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''serves the registry at /metrics'''
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        '''scrapes would flood the logs, so keep them out'''
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Metrics(object):
+    '''
+    exposes the registry either over http for prometheus to scrape, or as a text
+    file rewritten every 'interval' seconds, or both. the file is replaced
+    atomically so a reader never sees half a snapshot.
+    '''
+
+    def __init__(self, hostport=None, snapshot=None, interval=30.0):
+        self.hostport = hostport
+        self.snapshot = snapshot
+        self.interval = interval
+        self.logger = self._initialize_logger()
+        self.server = None
+        self.stopped = threading.Event()
+
+    def _initialize_logger(self):
+        logger = logging.getLogger('metrics')
+        logger.info('metrics logger instantiated')
+
+        return logger
+
+    def write_snapshot(self):
+        temp = '{}.tmp'.format(self.snapshot)
+
+        with open(temp, 'w') as snapshot:
+            snapshot.write(registry.render())
+
+        os.replace(temp, self.snapshot)
+
+    def _write_snapshots(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                self.logger.error('unable to write metrics snapshot {}: {}'.format(self.snapshot, e))
+
+    def start(self):
+        if self.hostport:
+            try:
+                self.server = MetricsServer(self.hostport, MetricsHandler)
+            except OSError as e:
+                self.logger.error('unable to serve metrics on port {}: {}'.format(self.hostport[1], e))
+            else:
+                self.logger.info('serving metrics on port {}'.format(self.hostport[1]))
+                threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+
+        if self.snapshot:
+            self.logger.info('writing metrics to {} every {} seconds'.format(self.snapshot, self.interval))
+            threading.Thread(target=self._write_snapshots, name='metrics-snapshot', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
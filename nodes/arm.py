@@ -4,7 +4,7 @@
 # updated: 6/10/18
 
 import logging
-from relay import relay  # relay repo is currently a submodule: https://github.com/barlaensdoonn/relay
+from backends import get_backend
 
 
 class Arm(object):
@@ -22,15 +22,17 @@ class Arm(object):
 
     actuator_order = ['low', 'mid-ext', 'mid-retract', 'top']
 
-    def __init__(self, arm, pins, **kwargs):
+    def __init__(self, arm, pins, backend=None, **kwargs):
         '''
         we accept **kwargs here to pass in board_type if needed.
-        pins should be a list of ints corresponding to GPIO pins to control actuators
+        pins should be a list of ints corresponding to GPIO pins to control actuators.
+        backend picks the relay class, see backends.get_backend(). by default it's
+        read from the MURMUR_RELAY_BACKEND environment variable, falling back to 'gpio'.
         '''
 
         self.arm = arm
         self.logger = self._initialize_logger()
-        self.actuators = self._initialize_actuators(pins, **kwargs)
+        self.actuators = self._initialize_actuators(pins, backend, **kwargs)
 
     def _initialize_logger(self):
         logger = logging.getLogger(self.arm)
@@ -38,9 +40,11 @@ class Arm(object):
 
         return logger
 
-    def _initialize_actuators(self, pins, **kwargs):
+    def _initialize_actuators(self, pins, backend, **kwargs):
         self.logger.info('initializing actuators on GPIO pins {}, {}, {}, {}'.format(*pins))
-        actuators = [relay.Relay(pin, **kwargs) for pin in pins]
+        Relay = get_backend(backend)
+        self.logger.info('using {} relays'.format(Relay.__name__))
+        actuators = [Relay(pin, **kwargs) for pin in pins]
 
         return dict(zip(self.actuator_order, actuators))
 
@@ -52,9 +56,9 @@ class Arm(object):
             self.actuators[actuator].test_connection()
 
     def activate(self, actuator):
-        self.logger.info('activating {}'.format(actuator))
+        self.logger.info('activating %s', actuator)
         self.actuators[actuator].activate()
 
     def deactivate(self, actuator):
-        self.logger.info('deactivating {}'.format(actuator))
+        self.logger.info('deactivating %s', actuator)
         self.actuators[actuator].deactivate()
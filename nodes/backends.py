@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+# murmur - relay backends, so the node stack can run without GPIO
+# 10/18/26
+
+import os
+import time
+import random
+import threading
+
+
+class Recorder(object):
+    '''
+    shared log of every change made through the recording backends, as
+    (time.monotonic(), relay, state) tuples in the order they were made.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changes = []
+
+    def record(self, relay, state, at=None):
+        with self.lock:
+            self.changes.append((time.monotonic() if at is None else at, relay, state))
+
+    def record_many(self, changes, at):
+        '''record (relay, state) changes that were all made at once'''
+        with self.lock:
+            self.changes.extend((at, relay, state) for relay, state in changes)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.changes)
+
+    def clear(self):
+        with self.lock:
+            del self.changes[:]
+
+
+recorder = Recorder()
+
+
+class RecordingRelay(object):
+    '''same interface as relay.Relay, but records every change in the recorder instead of driving a pin'''
+
+    def __init__(self, pin, **kwargs):
+        self.pin = pin
+        self.state = False
+
+    def activate(self):
+        self.state = True
+        recorder.record(self, True)
+
+    def deactivate(self):
+        self.state = False
+        recorder.record(self, False)
+
+    def test_connection(self):
+        pass
+
+    @classmethod
+    def write_many(cls, changes):
+        '''switch several relays in one write, they're all recorded with the same time'''
+        for relay, state in changes:
+            relay.state = state
+
+        recorder.record_many(changes, time.monotonic())
+
+
+class LatentRelay(RecordingRelay):
+    '''
+    recording relay that behaves more like the real thing. each call blocks for
+    'latency' seconds, like a GPIO write through gpiozero, and the change is
+    recorded 'switching' seconds later (give or take 'jitter') to account for the
+    relay contacts closing. the defaults come from MURMUR_RELAY_LATENCY,
+    MURMUR_RELAY_SWITCHING and MURMUR_RELAY_JITTER, in seconds.
+    '''
+
+    def __init__(self, pin, latency=None, switching=None, jitter=None, **kwargs):
+        super().__init__(pin, **kwargs)
+        self.latency = latency if latency is not None else float(os.environ.get('MURMUR_RELAY_LATENCY', 0.0001))
+        self.switching = switching if switching is not None else float(os.environ.get('MURMUR_RELAY_SWITCHING', 0.005))
+        self.jitter = jitter if jitter is not None else float(os.environ.get('MURMUR_RELAY_JITTER', 0.001))
+
+    def _switch(self, state):
+        time.sleep(self.latency)
+        self.state = state
+        recorder.record(self, state, at=time.monotonic() + max(0.0, random.gauss(self.switching, self.jitter)))
+
+    def activate(self):
+        self._switch(True)
+
+    def deactivate(self):
+        self._switch(False)
+
+    @classmethod
+    def write_many(cls, changes):
+        '''one write for all of the relays, like setting a GPIO register, so the latency is only paid once'''
+        first = changes[0][0]
+        time.sleep(first.latency)
+
+        for relay, state in changes:
+            relay.state = state
+
+        recorder.record_many(changes, time.monotonic() + max(0.0, random.gauss(first.switching, first.jitter)))
+
+
+def _gpio():
+    from relay import relay  # relay repo is currently a submodule: https://github.com/barlaensdoonn/relay
+
+    return relay.Relay
+
+
+backends = {
+    'gpio': _gpio,
+    'recorder': lambda: RecordingRelay,
+    'latency': lambda: LatentRelay
+}
+
+
+def write_relays(changes):
+    '''
+    set several relays at once, changes is a list of (relay, state) tuples. relay
+    classes that can switch a group of relays in a single write provide a
+    write_many() classmethod. the gpio relays have no group write, so they're
+    switched one after another with nothing else in between.
+    '''
+    if not changes:
+        return
+
+    cls = type(changes[0][0])
+
+    if hasattr(cls, 'write_many') and all(type(relay) is cls for relay, _ in changes):
+        cls.write_many(changes)
+        return
+
+    for relay, state in changes:
+        if state:
+            relay.activate()
+        else:
+            relay.deactivate()
+
+
+def get_backend(name=None):
+    '''
+    return the relay class for a backend: 'gpio' for the real relays, 'recorder'
+    or 'latency' to run without GPIO. if name isn't given it's read from the
+    MURMUR_RELAY_BACKEND environment variable, and defaults to 'gpio'.
+    the gpio driver is only imported when it's used.
+    '''
+    name = name if name else os.environ.get('MURMUR_RELAY_BACKEND', 'gpio')
+
+    if name not in backends:
+        raise ValueError("unknown relay backend '{}', expected one of {}".format(name, ', '.join(backends)))
+
+    return backends[name]()
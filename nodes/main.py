@@ -4,15 +4,25 @@
 # updated: 1/23/18
 
 import os
+import sys
 import yaml
 import socket
 import logging
 import logging.config
+
+# topology.py, metrics.py, logqueue.py and journal.py are shared with control, at the top of the repo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
 from node import Node
 from receive import Receive
+from metrics import Metrics
+from logqueue import install_queue
+from journal import Journal
 
 
 basepath = '/home/pi/gitbucket/murmur/nodes'
+metrics_hostport = ('', 9100)  # prometheus scrapes http://<node>:9100/metrics
+journal_path = os.path.join(basepath, 'journal')  # binary history of every actuator change, see journal.py
 
 
 def _get_logfile_name(hostname):
@@ -38,6 +48,7 @@ def configure_logger(hostname):
 
     log_config['handlers']['file']['filename'] = _get_logfile_name(hostname)
     logging.config.dictConfig(log_config)
+    install_queue(log_config)
     logging.info('* * * * * * * * * * * * * * * * * * * *')
     logging.info('logging configured')
 
@@ -47,7 +58,7 @@ def configure_logger(hostname):
 def initialize_node(hostname):
     logger.info('...initializing node...')
 
-    return Node(hostname)
+    return Node(hostname, journal=Journal(journal_path, hostname))
 
 
 def initialize_receive(node):
@@ -62,9 +73,14 @@ if __name__ == '__main__':
     node = initialize_node(hostname)
     receive = initialize_receive(node)
 
+    receive.multicast.start()
+    metrics = Metrics(hostport=metrics_hostport)
+    metrics.start()
+
     try:
         logger.info('receive server entering serve_forever() loop')
         receive.server.serve_forever()
     except KeyboardInterrupt:
         receive.server.shutdown()
+        receive.multicast.close()
         logger.info('...user exit received, shutting down server...')
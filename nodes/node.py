@@ -3,8 +3,18 @@
 # 12/9/17
 # updated: 6/16/18
 
+import time
 import logging
+import threading
 from arm import Arm
+from backends import write_relays
+from sequence import SequenceRunner
+from metrics import registry
+from topology import load_topology
+from protocol import APPLIED, REJECTED, UNKNOWN, MALFORMED, SCHEDULED, ack_statuses
+
+
+gpio_seconds = registry.histogram('murmur_gpio_apply_seconds', 'time to switch one relay, per arm and actuator')
 
 
 class Node(object):
@@ -17,23 +27,41 @@ class Node(object):
         'B': Arm(pin_groups[1]),
         'C': Arm(pin_groups[2])
     }
-    '''
 
-    host_arm_map = {
-        'murmur01': ['A', 'B', 'C'],
-        'murmur02': ['D', 'E', 'F'],
-        'murmur03': ['G', 'H', 'J'],
-        'murmur04': ['K', 'L', 'M']
-    }
+    the arms on each host and their pin groups, including any per node pin
+    overrides, come from topology.yaml at the top of the repo.
 
-    pin_groups = [[4, 17, 27, 22], [6, 13, 19, 26], [12, 16, 20, 21]]
+    the state of every relay on the node is kept as a bitmask in self.state,
+    and changes are applied by working out the new bitmask and writing only the
+    relays that differ, see _apply_vector().
 
-    def __init__(self, hostname, **kwargs):
-        '''we accept **kwargs here to pass in board_type if needed.'''
+    if a Journal is given, every actuator change parse_action() handles is
+    recorded in it with the status it got.
+    '''
+
+    # the controller schedules mid valve changes Timer.mid_delay (0.1) seconds
+    # apart. we check it again here, since both mids open at once fight each other,
+    # but only as a backstop: mid_separation is well under mid_delay so network and
+    # scheduler jitter on normal traffic never holds a mid back
+    mids = ('mid-ext', 'mid-retract')
+    mid_separation = 0.05
+
+    def __init__(self, hostname, topology=None, journal=None, **kwargs):
+        '''
+        we accept **kwargs here to pass in board_type or a relay backend if needed.
+        topology defaults to the one loaded from topology.yaml.
+        '''
 
         self.hostname = hostname
+        self.topology = topology if topology else load_topology()
+        self.journal = journal
+        self.lock = threading.Lock()  # guards self.state, the receive server calls parse_action from one thread per client
         self.logger = self._initialize_logger()
         self.arms = self._initialize_arms(**kwargs)
+        self.relays, self.bits = self._index_relays()
+        self.state = 0  # bit i is set when self.relays[i] is active
+        self.mid_changes = {arm: {mid: (False, 0.0) for mid in self.mids} for arm in self.arms}
+        self.runner = SequenceRunner(self)
 
     def _initialize_logger(self):
         logger = logging.getLogger('node')
@@ -41,16 +69,6 @@ class Node(object):
 
         return logger
 
-    def _modify_pin_groups(self):
-        '''
-        change murmur04's last pin_group, replacing GPIO pin 16 with 25.
-        this is due to a wiring fault at Mystic and should be corrected in later iterations
-        '''
-
-        if self.hostname == 'murmur04':
-            self.logger.info('modifying last pin group to [12, 25, 20, 21]')
-            self.pin_groups[-1] = [12, 25, 20, 21]
-
     def _intercept_d_low(self, arm, actuator):
         '''
         intercept a message to fire D low, and return F top
@@ -66,14 +84,14 @@ class Node(object):
     def _initialize_arms(self, **kwargs):
         '''
         the for loop and return statement can be replaced with this more unreadable one-liner:
-        return {arm: Arm(pins, self.hostname, **kwargs) for arm, pins in zip(arms, self.pin_groups)}
+        return {arm: Arm(arm, pins, **kwargs) for arm, pins in self.topology.get_pins(self.hostname).items()}
         '''
 
         arm_dict = {}
-        arms = self.host_arm_map[self.hostname]
-        self.logger.info('initializing arms {}, {}, and {}'.format(*arms))
+        pin_groups = self.topology.get_pins(self.hostname)
+        self.logger.info('initializing arms {}'.format(', '.join(pin_groups)))
 
-        for arm, pins in zip(arms, self.pin_groups):
+        for arm, pins in pin_groups.items():
             arm_dict[arm] = Arm(arm, pins, **kwargs)
 
         return arm_dict
@@ -84,26 +102,214 @@ class Node(object):
         for arm in self.arms:
             self.arms[arm].test_connections()
 
-    def parse_action(self, action):
+    def _index_relays(self):
         '''
-        this is called in the receive module by the TCP server when a valid message is received.
-        specifically it's called by the TCPHandler class in its handle() method after the msg is parsed
+        give every relay on the node a bit in the state vector, in arm order and then
+        actuator order. returns the relays in bit order, with (arm, actuator) -> bit.
         '''
+        relays = []
+        bits = {}
 
-        try:
+        for arm_name, arm in self.arms.items():
+            for actuator in arm.actuator_order:
+                bits[(arm_name, actuator)] = len(relays)
+                relays.append((arm_name, actuator, arm.actuators[actuator]))
+
+        return relays, bits
+
+    def _get_changes(self, steps):
+        '''
+        turn steps into a list of (bit, arm, actuator, activate), raising KeyError for
+        arms or actuators that aren't on this node before anything is applied
+        '''
+        changes = []
+
+        for step in steps:
             # NOTE: this should be replaced in future iterations. this is a hack
             # to work around a failed relay, we repurpose F top to use for D low
-            string_arm, string_actuator = self._intercept_d_low(action['arm'], action['actuator'])
-            arm = self.arms[string_arm]
-            actuator = string_actuator
+            arm, actuator = self._intercept_d_low(step['arm'], step['actuator'])
+            changes.append((self.bits[(arm, actuator)], arm, actuator, bool(step['activate'])))
+
+        return changes
+
+    def _commit(self, target):
+        '''write the relays whose bit differs between target and the current state, all at once'''
+        changed = target ^ self.state
+
+        if not changed:
+            return
+
+        writes = [(i, bool(target >> i & 1)) for i in range(len(self.relays)) if changed >> i & 1]
+        started = time.monotonic()
+        write_relays([(self.relays[i][2], state) for i, state in writes])
+        now = time.monotonic()
+        self.state = target
+
+        for i, state in writes:
+            arm, actuator, _ = self.relays[i]
+            gpio_seconds.observe(now - started, arm=arm, actuator=actuator)
+
+            if actuator in self.mids:
+                self.mid_changes[arm][actuator] = (state, now)
+
+    def _commit_vector(self, steps):
+        '''
+        work out the target bitmask for every relay on the node with the mid valve
+        interlock checked against it, and write the relays that change, in one go
+        if the relay backend allows it. the caller holds self.lock.
+
+        activating a mid while the arm's other mid is open in the target is refused.
+        a mid that opens less than mid_separation seconds after the other mid closed,
+        including when the other mid closes in this same vector, is left out.
+        returns (applied, held, wait): applied is False if anything was refused,
+        held are the steps left out and wait is how long until they can go.
+        '''
+        applied = True
+        target = self.state
+        held = []
+        wait = 0.0
+        now = time.monotonic()
+
+        for step, (bit, arm, actuator, activate) in zip(steps, self._get_changes(steps)):
+            mask = 1 << bit
+
+            if not activate:
+                target &= ~mask
+                continue
+
+            if actuator in self.mids and not self.state & mask:
+                other = self.mids[1] if actuator == self.mids[0] else self.mids[0]
+                other_mask = 1 << self.bits[(arm, other)]
+
+                if target & other_mask:
+                    self.logger.error('refusing to activate {arm} {actuator} while {arm} {other} is active'.format(arm=arm, actuator=actuator, other=other))
+                    applied = False
+                    continue
 
-            activate = action['activate']
+                if self.state & other_mask:
+                    remaining = self.mid_separation
+                else:
+                    remaining = self.mid_separation - (now - self.mid_changes[arm][other][1])
 
-            if activate:
-                arm.actuators[actuator].activate()
+                if remaining > 0:
+                    # routine enough to be rate limited, which warnings never are
+                    self.logger.debug('%s %s changed %.3fs ago, waiting before activating %s', arm, other, self.mid_separation - remaining, actuator)
+                    held.append(step)
+                    wait = max(wait, remaining)
+                    continue
+
+            target |= mask
+
+        self._commit(target)
+
+        return applied, held, wait
+
+    def _apply_vector(self, steps):
+        '''
+        apply steps that should happen together as a single state vector, see
+        _commit_vector(). held mids are committed once their gap has passed, and
+        checked against the interlock again then. the node's lock is only held
+        while a vector is worked out and written, never while waiting, so other
+        clients and the SequenceRunner can change other arms in the meantime.
+        returns False if the interlock refused any of the steps.
+        '''
+        with self.lock:
+            applied, held, wait = self._commit_vector(steps)
+
+        while held:
+            time.sleep(wait)
+
+            with self.lock:
+                committed, held, wait = self._commit_vector(held)
+
+            applied = committed and applied
+
+        return applied
+
+    def _apply(self, action):
+        return self._apply_vector([action])
+
+    def _apply_batch(self, batch):
+        '''
+        apply every step of a batch message in order. a step can carry a 'delay'
+        in seconds to wait before the next step, the steps between delays are
+        applied together as one state vector. the delays are waited out without
+        holding the node's lock. returns False if the interlock rejected any of
+        the steps, the rest are still applied.
+        '''
+        applied = True
+        group = []
+
+        for i, step in enumerate(batch):
+            group.append(step)
+
+            if step.get('delay') and i < len(batch) - 1:
+                applied = self._apply_vector(group) and applied
+                group = []
+                time.sleep(step['delay'])
+
+        if group:
+            applied = self._apply_vector(group) and applied
+
+        return applied
+
+    def _journal(self, action, status, seq, latency):
+        '''record the changes in a batch or single actuator action'''
+        if self.journal is None or not isinstance(action, dict) or 'upload' in action or 'cue' in action:
+            return
+
+        steps = action['batch'] if 'batch' in action else [action]
+
+        try:
+            self.journal.record([(step['arm'], step['actuator'], step['activate']) for step in steps], ack_statuses[status], seq=seq, latency=latency)
+        except (TypeError, KeyError):
+            pass  # too malformed to say which actuators it was for
+
+    def parse_action(self, action, seq=0):
+        '''
+        this is called in the receive module by the TCP server when a valid message is received.
+        specifically it's called by the TCPHandler class in its handle() method after the msg is parsed.
+        action is either a single actuator change, a batch of them under the 'batch' key,
+        or an 'upload' or 'cue' message for the SequenceRunner. the runner calls this
+        method with batch actions as well when it's running a sequence.
+
+        a batch with an 'at' timestamp in the future is checked and handed to the
+        runner to apply then, so the receive thread carries on with the client's
+        next message instead of waiting for it. it returns SCHEDULED, and the batch
+        is journaled when it's applied.
+
+        returns one of the status codes in protocol.py, which the receive
+        server sends back to the controller in its acknowledgement. seq is the
+        sequence number the action arrived with, for the journal.
+        '''
+        status = APPLIED
+        started = time.monotonic()
+
+        try:
+            if 'batch' in action and action.get('at') is not None and float(action['at']) > time.time():
+                self._get_changes(action['batch'])
+                self.runner.schedule(float(action['at']), {'batch': action['batch']}, seq=seq)
+                return SCHEDULED
+
+            if 'upload' in action:
+                self.runner.upload(action['upload'])
+            elif 'cue' in action:
+                self.runner.cue(action)
             else:
-                arm.actuators[actuator].deactivate()
-        except TypeError:
+                if 'batch' in action:
+                    applied = self._apply_batch(action['batch'])
+                else:
+                    applied = self._apply(action)
+
+                if not applied:
+                    status = REJECTED
+        except (TypeError, AttributeError, ValueError):
             self.logger.warning('received improperly formatted message {}, ignoring...'.format(action))
+            status = MALFORMED
         except KeyError:
             self.logger.error('invalid command received, ignoring...')
+            status = UNKNOWN
+
+        self._journal(action, status, seq, time.monotonic() - started)
+
+        return status
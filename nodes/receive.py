@@ -4,9 +4,30 @@
 # updated: 6/17/18
 
 import json
+import time
 import socket
 import logging
+import threading
 import socketserver
+from metrics import registry
+from protocol import (PROTOCOL_VERSION, BATCH_MAGIC, TIMED_BATCH_MAGIC, ACK_MAGIC, FLEET_MAGIC, BATCH_HEADER, TIMED_BATCH_HEADER,
+                      FLEET_HEADER, ENTRY, ACK, ACTIVATE, MULTICAST_GROUP, MULTICAST_PORT)
+from topology import load_topology
+
+
+# binary protocol and multicast fleet frames, see protocol.py for the wire format.
+# clients ask for the binary protocol with a 'hello' message when they connect.
+HEADERS = {
+    BATCH_MAGIC: BATCH_HEADER,
+    TIMED_BATCH_MAGIC: TIMED_BATCH_HEADER
+}
+
+parse_seconds = registry.histogram('murmur_node_parse_seconds', 'time to parse a message into an action, per message kind')
+
+# ids are positions in topology.yaml, the same as on the controller
+topology = load_topology()
+arm_names = topology.arms
+actuator_names = topology.actuators
 
 
 class TCPHandler(socketserver.BaseRequestHandler):
@@ -14,43 +35,326 @@ class TCPHandler(socketserver.BaseRequestHandler):
     the request handler class for our server. it is instantiated once
     per connection to the server, and must override the handle() method
     to implement communication to the client.
+
+    the server runs each connection in its own thread, so the control pi, debug
+    tools and monitoring can all be connected at once. clients keep their
+    connection open and send many messages over it, so handle() loops until the
+    client disconnects or the connection has been idle for longer than the
+    server's idle_timeout.
+
+    json messages are newline delimited, binary frames start with a magic byte
+    and their length follows from their header. data is accumulated in a buffer
+    and every complete message is handled in order, so several messages arriving
+    in one packet and a message split across several packets both work.
     '''
 
-    def parse_msg(self):
-        '''self.request is the TCP socket connected to the client'''
+    max_buffer = 65536  # drop clients that send this much without completing a message
 
-        # receive data
-        data = self.request.recv(1024)
-        self.decoded = data.decode().strip()
-        self.server.logger.info('{} wrote: {}'.format(self.client_address[0], self.decoded))
+    def setup(self):
+        self.buffer = b''
+        self.request.settimeout(self.server.idle_timeout)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        # acknowledge message was received by sending it back
-        self.server.logger.debug('sending acknowledgement back to client')
-        self.request.sendall(data)
+    def _split_frames(self):
+        '''pull every complete json line and binary frame out of the buffer'''
+        frames = []
+
+        while self.buffer:
+            header = HEADERS.get(self.buffer[0])
+
+            if header:
+                # the entry count is the fourth byte of both binary headers
+                if len(self.buffer) < header.size:
+                    break
+
+                size = header.size + self.buffer[3] * ENTRY.size
+            else:
+                size = self.buffer.find(b'\n') + 1
+
+            if not 0 < size <= len(self.buffer):
+                break
+
+            frame, self.buffer = self.buffer[:size], self.buffer[size:]
+
+            if header or frame.strip():
+                frames.append(frame if header else frame[:-1])
+
+        return frames
+
+    def _read_frames(self):
+        '''
+        receive data until at least one complete message is buffered and return all
+        complete messages. returns None when the client has gone away.
+        '''
+        frames = self._split_frames()
+
+        while not frames:
+            try:
+                data = self.request.recv(4096)
+            except socket.timeout:
+                self.server.logger.info('connection from {} idle for over {} seconds'.format(self.client_address[0], self.server.idle_timeout))
+                return None
+            except ConnectionResetError:
+                return None
+
+            if not data:
+                return None
+
+            self.buffer += data
+
+            if len(self.buffer) > self.max_buffer:
+                self.server.logger.error('{} sent {} bytes without completing a message, dropping connection'.format(self.client_address[0], len(self.buffer)))
+                return None
+
+            frames = self._split_frames()
+
+        return frames
+
+    def _reply_sync(self, msg, received):
+        '''
+        answer a clock sync request from the controller with the time we received it
+        and the time we're sending the reply, both from our own clock. the controller
+        uses these with its own send and receive times to estimate our clock offset.
+        '''
+        reply = {'sync': msg['sync'], 'received': received, 'sent': time.time()}
+        self.request.sendall('{}\r\n'.format(json.dumps(reply)).encode())
+
+    def _reply_hello(self, msg):
+        '''agree to the highest binary protocol version both of us support, or json if the hello makes no sense'''
+        try:
+            reply = {'hello': max(0, min(int(msg['hello']), PROTOCOL_VERSION))}
+        except (ValueError, TypeError):
+            reply = {'hello': 0}
+
+        self.server.logger.info('{} asked for protocol {}, using {}'.format(self.client_address[0], msg['hello'], reply['hello']))
+        self.request.sendall('{}\r\n'.format(json.dumps(reply)).encode())
+
+    def parse_frame(self, frame):
+        '''
+        unpack a binary batch frame into the same batch action a json message would
+        give us. returns the frame's sequence number and the action.
+        '''
+        header = HEADERS[frame[0]]
+        fields = header.unpack_from(frame)
+        batch = [
+            {
+                'arm': arm_names[arm] if arm < len(arm_names) else None,
+                'actuator': actuator_names[actuator] if actuator < len(actuator_names) else None,
+                'activate': bool(flags & ACTIVATE)
+            }
+            for arm, actuator, flags in ENTRY.iter_unpack(frame[header.size:])
+        ]
+        self.server.logger.info('%s sent frame %s: %s', self.client_address[0], fields[1], batch)
+
+        action = {'batch': batch}
+
+        if frame[0] == TIMED_BATCH_MAGIC:
+            action['at'] = fields[3]
+
+        return fields[1], action
+
+    def parse_msg(self, data, received):
+        '''
+        data is a single line received from the client, without its newline, and
+        received is the time.time() it arrived. returns the parsed action, or None
+        if the message was a clock sync request, which is answered here.
+        '''
+
+        self.decoded = data.decode().strip()
+        self.server.logger.info('%s wrote: %s', self.client_address[0], self.decoded)
 
         # message should be in json format
         try:
-            return json.loads(self.decoded)
+            action = json.loads(self.decoded)
         except Exception:
             self.server.logger.error('exception!!')
+            action = None
+
+        if isinstance(action, dict) and 'sync' in action:
+            self._reply_sync(action, received)
+            return None
+
+        if isinstance(action, dict) and 'hello' in action:
+            self._reply_hello(action)
+            return None
+
+        # acknowledge message was received by sending it back
+        self.server.logger.debug('sending acknowledgement back to client')
+        self.request.sendall(data + b'\n')
+
+        return action
+
+    def _handle_frames(self, frames, received):
+        for frame in frames:
+            started = time.monotonic()
+
+            if frame[0] in HEADERS:
+                # frames are acked once they've been applied, with the node's status
+                seq, action = self.parse_frame(frame)
+                parse_seconds.observe(time.monotonic() - started, kind='binary')
+                status = self.server.node.parse_action(action, seq=seq)
+                self.request.sendall(ACK.pack(ACK_MAGIC, seq, status))
+                continue
+
+            action = self.parse_msg(frame, received)
+            parse_seconds.observe(time.monotonic() - started, kind='json')
+
+            if action is not None:
+                self.server.node.parse_action(action)
 
     def handle(self):
-        self.server.logger.debug('client {} connected'.format(self.client_address[0]))
-        action = self.parse_msg()
-        self.server.node.parse_action(action)
+        self.server.logger.debug('client %s connected', self.client_address[0])
+
+        while True:
+            frames = self._read_frames()
+            received = time.time()
+
+            if frames is None:
+                break
+
+            try:
+                self._handle_frames(frames, received)
+            except (BrokenPipeError, ConnectionResetError):
+                self.server.logger.warning('client {} went away before we could reply'.format(self.client_address[0]))
+                break
 
     def finish(self):
         '''finish method is always called by the base handler after handle method has completed'''
-        self.server.logger.debug('closing connection from {}'.format(self.client_address[0]))
+        self.server.logger.debug('closing connection from %s', self.client_address[0])
+
+
+class ReceiveServer(socketserver.ThreadingTCPServer):
+    '''
+    TCP server that handles each client connection in its own daemon thread,
+    so a slow or idle client never holds up the accept loop or other clients.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MulticastReceiver(object):
+    '''
+    listens for fleet frames multicast by the controller and applies the changes
+    for this node's arms. the controller sends every datagram several times, so we
+    remember the highest sequence number applied from each sender session and drop
+    anything that isn't newer. the changes only set states, so a datagram we miss
+    entirely is covered by the controller's next one.
+    '''
+
+    def __init__(self, node, logger, group=MULTICAST_GROUP, port=MULTICAST_PORT, interface='0.0.0.0'):
+        self.node = node
+        self.logger = logger
+        self.group = group
+        self.port = port
+        self.interface = interface
+        self.sessions = {}  # session id -> highest sequence number applied
+        self.sock = None
+        self.thread = None
+
+    def _open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', self.port))
+        membership = socket.inet_aton(self.group) + socket.inet_aton(self.interface)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+        return sock
+
+    def _is_new(self, session, seq):
+        last = self.sessions.get(session)
+
+        # sequence numbers are uint32 and wrap, compare them modulo 2**32
+        if last is not None and not 0 < (seq - last) & 0xFFFFFFFF < 0x80000000:
+            return False
+
+        self.sessions[session] = seq
+
+        return True
+
+    def parse_datagram(self, data, sender):
+        '''
+        returns the datagram's sequence number and the batch action for our arms in
+        its fleet frame, or None if there's nothing to apply
+        '''
+        if len(data) < FLEET_HEADER.size or data[0] != FLEET_MAGIC:
+            self.logger.warning('{} sent an invalid multicast datagram'.format(sender))
+            return None
+
+        _, session, seq, count = FLEET_HEADER.unpack_from(data)
+
+        if len(data) != FLEET_HEADER.size + count * ENTRY.size:
+            self.logger.warning('{} sent a truncated multicast datagram'.format(sender))
+            return None
+
+        if not self._is_new(session, seq):
+            self.logger.debug('dropping repeat of multicast datagram %s from %s', seq, sender)
+            return None
+
+        batch = []
+
+        for arm, actuator, flags in ENTRY.iter_unpack(data[FLEET_HEADER.size:]):
+            arm = arm_names[arm] if arm < len(arm_names) else None
+
+            if arm in self.node.arms:
+                batch.append({
+                    'arm': arm,
+                    'actuator': actuator_names[actuator] if actuator < len(actuator_names) else None,
+                    'activate': bool(flags & ACTIVATE)
+                })
+
+        self.logger.info('%s multicast datagram %s: %s', sender, seq, batch)
+
+        return (seq, {'batch': batch}) if batch else None
+
+    def _listen(self):
+        while True:
+            try:
+                data, (sender, _) = self.sock.recvfrom(2048)
+            except OSError:
+                break
+
+            started = time.monotonic()
+            parsed = self.parse_datagram(data, sender)
+            parse_seconds.observe(time.monotonic() - started, kind='multicast')
+
+            if parsed is not None:
+                seq, action = parsed
+                self.node.parse_action(action, seq=seq)
+
+    def start(self):
+        '''join the multicast group and start listening in a daemon thread'''
+        try:
+            self.sock = self._open()
+        except OSError as e:
+            self.logger.error('unable to join multicast group {}: {}, fleet commands will only arrive over TCP'.format(self.group, e))
+            return
+
+        self.logger.info('listening for multicast on {}:{}'.format(self.group, self.port))
+        self.thread = threading.Thread(target=self._listen, name='multicast', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
 
 
 class Receive(object):
-    '''class containing a TCPServer that receives messages and translates them into Node actions'''
+    '''
+    class containing a threaded TCP server that receives messages and translates them into Node actions,
+    and a MulticastReceiver for fleet-wide changes, which needs to be started separately
+    '''
+
+    idle_timeout = 300  # seconds before an open connection with no traffic is dropped
 
-    def __init__(self, node):
+    def __init__(self, node, hostport=('', 9999)):
+        '''hostport defaults to port 9999 on all available interfaces, '' stands for all of them'''
         self.logger = self._initialize_logger()
         self.node = node
+        self.hostport = hostport
         self.server = self._initialize_server()
+        self.multicast = MulticastReceiver(node, self.logger)
 
     def _initialize_logger(self):
         logger = logging.getLogger('receive')
@@ -59,13 +363,13 @@ class Receive(object):
         return logger
 
     def _initialize_server(self):
-        hostport = ('', 9999)  # '' stands for all available interfaces
         hostname = socket.gethostname()
-        self.logger.info('host {hostname} initializing open TCP server on port {port}'.format(hostname=hostname, port=hostport[1]))
+        self.logger.info('host {hostname} initializing open TCP server on port {port}'.format(hostname=hostname, port=self.hostport[1]))
 
-        server = socketserver.TCPServer(hostport, TCPHandler)
+        server = ReceiveServer(self.hostport, TCPHandler)
         server.logger = self.logger
         server.hostname = hostname
         server.node = self.node
+        server.idle_timeout = self.idle_timeout
 
         return server
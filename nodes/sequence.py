@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# murmur - run uploaded sequences locally on a node
+# 10/18/26
+
+import time
+import heapq
+import logging
+import threading
+import itertools
+
+
+class SequenceRunner(object):
+    '''
+    runs sequences that the controller uploaded ahead of time, so the network
+    isn't involved in any of the actuation once a sequence has started.
+
+    an uploaded sequence is this node's slice of a compiled timeline, formatted as
+    a list of [offset, changes] pairs sorted by offset, where offset is seconds from
+    the start of the sequence and changes is a list of [arm, actuator, activate].
+    each entry is converted to a batch action up front and handed to
+    Node.parse_action() when its time comes.
+
+    the controller drives the runner with cues:
+        'start'  start running 'sequence' at the unix timestamp 'at', which is
+                 shared by every node so they all start together
+        'pause'  stop where we are until 'resume'
+        'resume' carry on, pushing the rest of the sequence back by the time paused
+        'stop'   abandon the running sequence
+
+    the same thread applies timed batches that arrive with an 'at' timestamp,
+    see schedule(), so the receive server never has to wait for one.
+    '''
+
+    def __init__(self, node):
+        self.node = node
+        self.logger = self._initialize_logger()
+        self.sequences = {}
+        self.condition = threading.Condition()
+        self.running = None
+        self.start = None
+        self.index = 0
+        self.paused_at = None
+        self.timed = []  # heap of (at, order, action, seq)
+        self.order = itertools.count()
+        self.thread = threading.Thread(target=self._run, name='sequence', daemon=True)
+        self.thread.start()
+
+    def _initialize_logger(self):
+        logger = logging.getLogger('sequence')
+        logger.info('sequence logger instantiated')
+
+        return logger
+
+    def upload(self, upload):
+        steps = [
+            (float(offset), {'batch': [{'arm': arm, 'actuator': actuator, 'activate': activate} for arm, actuator, activate in changes]})
+            for offset, changes in upload['steps']
+        ]
+        steps.sort(key=lambda step: step[0])
+
+        with self.condition:
+            self.sequences[upload['sequence']] = steps
+
+        self.logger.info("sequence '{}' uploaded with {} steps".format(upload['sequence'], len(steps)))
+
+    def cue(self, cue):
+        with self.condition:
+            if cue['cue'] == 'start':
+                if cue['sequence'] not in self.sequences:
+                    self.logger.error("cued to start sequence '{}' which hasn't been uploaded".format(cue['sequence']))
+                    return
+
+                self.logger.info("starting sequence '{}' at {}".format(cue['sequence'], cue['at']))
+                self.running = cue['sequence']
+                self.start = float(cue['at'])
+                self.index = 0
+                self.paused_at = None
+            elif cue['cue'] == 'pause' and self.running and self.paused_at is None:
+                self.logger.info("pausing sequence '{}'".format(self.running))
+                self.paused_at = time.time()
+            elif cue['cue'] == 'resume' and self.paused_at is not None:
+                self.logger.info("resuming sequence '{}'".format(self.running))
+                self.start += time.time() - self.paused_at
+                self.paused_at = None
+            elif cue['cue'] == 'stop':
+                self.logger.info("stopping sequence '{}'".format(self.running))
+                self.running = None
+            else:
+                self.logger.debug('ignoring cue {}'.format(cue))
+
+            self.condition.notify()
+
+    def schedule(self, at, action, seq=0):
+        '''apply a batch action at the unix timestamp at, independently of any running sequence'''
+        with self.condition:
+            heapq.heappush(self.timed, (at, next(self.order), action, seq))
+            self.condition.notify()
+
+    def _next_action(self):
+        '''
+        wait, holding the condition, until the next step or timed batch is due and
+        return its batch action with its sequence number. any cue or timed batch
+        wakes us up so we re-evaluate what to do next.
+        '''
+        with self.condition:
+            while True:
+                now = time.time()
+                deadlines = []
+
+                if self.timed:
+                    if self.timed[0][0] <= now:
+                        _, _, action, seq = heapq.heappop(self.timed)
+                        return action, seq
+
+                    deadlines.append(self.timed[0][0])
+
+                if self.running is not None and self.paused_at is None:
+                    steps = self.sequences[self.running]
+
+                    if self.index >= len(steps):
+                        self.logger.info("done running sequence '{}'".format(self.running))
+                        self.running = None
+                        continue
+
+                    offset, action = steps[self.index]
+
+                    if self.start + offset <= now:
+                        self.index += 1
+                        return action, 0
+
+                    deadlines.append(self.start + offset)
+
+                self.condition.wait(min(deadlines) - now if deadlines else None)
+
+    def _run(self):
+        while True:
+            action, seq = self._next_action()
+            self.node.parse_action(action, seq=seq)
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+# murmur - the binary wire format shared by control and the nodes
+# 10/18/26
+
+import struct
+
+
+# binary protocol, negotiated per connection with a HelloMessage. json messages
+# are still accepted on a binary connection, since a frame's magic byte can never
+# start a json line. all fields are little endian:
+#   batch frame        magic 0xA5, uint16 sequence number, uint8 entry count
+#   timed batch frame  magic 0xA6, uint16 sequence number, uint8 entry count, float64 node time to apply at
+#   entry              uint8 arm id, uint8 actuator id, uint8 flags (bit 0 is activate)
+#   ack frame          magic 0xA7, uint16 sequence number, uint8 status
+# the node acks a frame once it has been handled, with a status from ack_statuses.
+# a timed batch is acked 'scheduled' as soon as the node has queued it.
+#
+# fleet-wide state changes can also go out as a single UDP multicast datagram,
+# see Multicaster in control/send.py. those are never acked:
+#   fleet frame        magic 0xA8, uint32 session id, uint32 sequence number, uint8 entry count, then entries
+#
+# arm and actuator ids are positions in topology.yaml, so they're the same on both ends.
+PROTOCOL_VERSION = 1
+BATCH_MAGIC = 0xA5
+TIMED_BATCH_MAGIC = 0xA6
+ACK_MAGIC = 0xA7
+FLEET_MAGIC = 0xA8
+BATCH_HEADER = struct.Struct('<BHB')
+TIMED_BATCH_HEADER = struct.Struct('<BHBd')
+FLEET_HEADER = struct.Struct('<BIIB')
+ENTRY = struct.Struct('<BBB')
+ACK = struct.Struct('<BHB')
+ACTIVATE = 0x01
+MULTICAST_GROUP = '239.255.77.77'
+MULTICAST_PORT = 9998
+
+# statuses returned by Node.parse_action() and sent back in ack frames
+APPLIED = 0
+REJECTED = 1
+UNKNOWN = 2
+MALFORMED = 3
+SCHEDULED = 4
+
+ack_statuses = {APPLIED: 'applied', REJECTED: 'rejected', UNKNOWN: 'unknown actuator', MALFORMED: 'malformed', SCHEDULED: 'scheduled'}
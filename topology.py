@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+# murmur - load the installation's topology from topology.yaml
+# 10/18/26
+
+import os
+import yaml
+from collections import OrderedDict
+
+
+# topology.yaml lives next to this module at the top of the repo, shared by control and the nodes
+default_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'topology.yaml')
+loaded = {}
+
+
+class Topology(object):
+    '''
+    the nodes, arms and pins of the piece, see topology.yaml for the format.
+    everything is indexed up front, so looking up an arm's host, id or pins is
+    a dict lookup however many arms there are:
+
+        hosts          node hostnames, in file order
+        arms           every arm, in file order. an arm's position is its id on the wire
+        actuators      actuator names, in pin group order
+        host_arm_map   host -> list of its arms
+        arm_ids        arm -> position in arms
+        arm_hosts      arm -> host
+        host_pins      host -> {arm: pins}
+        levels         arm -> ring the arm is on
+        orderings      name -> list of arms, such as 'all_arms_cw' or 'top_arms_ccw'
+    '''
+
+    def __init__(self, config):
+        self.actuators = list(config['actuators'])
+        self.pin_groups = [list(pins) for pins in config['pin_groups']]
+        self.host_arm_map = OrderedDict((host, list(node['arms'])) for host, node in config['nodes'].items())
+        self.hosts = list(self.host_arm_map)
+        self.arms = [arm for arms in self.host_arm_map.values() for arm in arms]
+        self.arm_ids = {arm: i for i, arm in enumerate(self.arms)}
+        self.arm_hosts = {arm: host for host, arms in self.host_arm_map.items() for arm in arms}
+        self.host_pins = {host: self._get_pins(host, node) for host, node in config['nodes'].items()}
+        self.levels = OrderedDict((place['arm'], place.get('level')) for place in config['geometry'])
+        self.orderings = self._get_orderings(config.get('orderings') or {})
+        self._check()
+
+    def _get_pins(self, host, node):
+        '''pin groups are assigned to a node's arms in order, unless the node overrides them'''
+        overrides = node.get('pins') or {}
+        pins = OrderedDict()
+
+        for i, arm in enumerate(node['arms']):
+            if arm in overrides:
+                pins[arm] = list(overrides[arm])
+            elif i < len(self.pin_groups):
+                pins[arm] = list(self.pin_groups[i])
+            else:
+                raise ValueError('{} has no pin group for arm {}'.format(host, arm))
+
+        return pins
+
+    def _get_orderings(self, explicit):
+        '''
+        clockwise and counterclockwise orderings of all arms and of each ring,
+        generated from the geometry, e.g. 'all_arms_cw' and 'bottom_arms_ccw'.
+        explicit orderings from the file replace generated ones of the same name.
+        '''
+        clockwise = list(self.levels)
+        orderings = OrderedDict([('all_arms_cw', clockwise), ('all_arms_ccw', clockwise[::-1])])
+
+        for level in OrderedDict.fromkeys(level for level in self.levels.values() if level):
+            arms = [arm for arm in clockwise if self.levels[arm] == level]
+            orderings['{}_arms_cw'.format(level)] = arms
+            orderings['{}_arms_ccw'.format(level)] = arms[::-1]
+
+        for name, arms in explicit.items():
+            orderings[name] = list(arms)
+
+        return orderings
+
+    def _check(self):
+        if len(self.arm_ids) != len(self.arms):
+            raise ValueError('an arm is listed on more than one node')
+
+        if set(self.levels) != set(self.arms):
+            raise ValueError('geometry must list every arm exactly once')
+
+        for name, arms in self.orderings.items():
+            unknown = [arm for arm in arms if arm not in self.arm_ids]
+
+            if unknown:
+                raise ValueError("ordering '{}' has unknown arms {}".format(name, unknown))
+
+    def address(self, host):
+        '''nodes are reached by their mDNS name'''
+        return '{}.local'.format(host)
+
+    def get_host(self, arm):
+        return self.arm_hosts[arm]
+
+    def get_pins(self, host):
+        '''return {arm: pins} for the arms on host'''
+        return self.host_pins[host]
+
+
+def load_topology(path=None):
+    '''load and index a topology file once, later calls return the same Topology'''
+    path = path if path else default_path
+
+    if path not in loaded:
+        with open(path, 'r') as topology:
+            loaded[path] = Topology(yaml.safe_load(topology))
+
+    return loaded[path]